@@ -0,0 +1,209 @@
+import logging, math, os, shutil, subprocess, threading, time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Songs are decoded to mono at a low sample rate, which is plenty for measuring loudness
+SAMPLE_RATE = 22050
+
+# Loudness is measured like ReplayGain: the RMS of 50 ms windows, taking the level that 95% of windows are below
+WINDOW = SAMPLE_RATE * 50 // 1000
+PERCENTILE = 95
+
+# Results are saved after this many songs, so a background pass that's stopped early doesn't lose its work
+SAVE_EVERY = 20
+
+# Level songs are adjusted to in dB relative to full scale, and the most a song will be turned up or down
+TARGET_LEVEL = -18
+MAX_GAIN = 12
+
+def decode(path):
+    '''
+    Decodes a song to 16 bit mono samples with ffmpeg.
+    '''
+    args = ["ffmpeg", "-v", "error", "-i", path, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"]
+    result = subprocess.run(args, stdin=subprocess.DEVNULL, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+def gain(samples):
+    '''
+    Gets how many dB to adjust a song by so it plays at the target loudness.
+    '''
+    count = len(samples) // WINDOW
+
+    if not count:
+        return None
+
+    windows = samples[:count * WINDOW].reshape(count, WINDOW).astype(np.float32) / 32768
+    rms = np.sqrt(np.mean(np.square(windows), axis=1))
+    level = float(np.percentile(rms, PERCENTILE))
+
+    # Silence can't be made louder
+    if level <= 0:
+        return None
+
+    return float(np.clip(TARGET_LEVEL - 20 * math.log10(level), -MAX_GAIN, MAX_GAIN))
+
+def analyse_file(path):
+    '''
+    Gets the real duration of a song from its MP3 headers and how much to adjust its volume by. Returns the duration,
+    gain, and an error if the file couldn't be read. The gain is None if ffmpeg isn't installed.
+    '''
+    from mutagen.mp3 import MP3
+
+    try:
+        duration = MP3(path).info.length
+    except Exception as e:
+        return None, None, str(e)
+
+    try:
+        return duration, gain(decode(path)), None
+    except FileNotFoundError:
+        return duration, None, None
+    except (OSError, subprocess.CalledProcessError) as e:
+        return duration, None, str(e)
+
+class Analyser:
+    '''
+    Measures downloaded songs on a pool of worker processes.
+
+    Results are saved in the database along with the file's modification time, so each file is only analysed once.
+    Songs measured before ffmpeg was installed are measured again once it is.
+    '''
+    def __init__(self, options, database):
+        self.options = options
+        self.database = database
+
+        # How many dB to adjust each song by, for songs we know
+        self.gains = {}
+
+        # Without ffmpeg, only durations can be read
+        self.can_measure = shutil.which("ffmpeg") is not None
+
+        if options.normalise_volume and not self.can_measure:
+            logging.warning("ffmpeg isn't installed, so song volumes can't be normalised")
+
+        # Pass over a whole playlist running in the background, and how to ask it to stop
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def analyse(self, songs, background=False):
+        '''
+        Uses saved results for songs analysed since they were downloaded, and analyses the rest. With `background`, the
+        rest are analysed on a background thread and their results are used as they come in.
+        '''
+        paths = {song.key: os.fspath(song.file_path(self.options.songs_path)) for song in songs if song.is_downloaded(self.options.songs_path)}
+        results = self.database.select_analysis(paths)
+        pending = []
+
+        for key, path in paths.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            if key not in results or results[key][0] != mtime or results[key][2] is None and self.can_measure:
+                pending.append((key, path, mtime))
+
+        self.apply(songs, results)
+
+        if not pending:
+            return
+
+        if background:
+            # Only one pass at a time, anything the last one didn't get to is in this one's pending songs
+            self.close()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.analyse_pending, args=(songs, pending, False), name="analyser", daemon=True)
+            self.thread.start()
+        else:
+            self.analyse_pending(songs, pending, True)
+
+    def apply(self, songs, results):
+        '''
+        Updates the durations and gains of songs from analysis results.
+        '''
+        for song in songs:
+            if song.key not in results:
+                continue
+
+            _, duration, gain = results[song.key]
+
+            if duration:
+                song.duration = duration
+            if gain is not None:
+                self.gains[song.key] = gain
+
+    def analyse_pending(self, songs, pending, progress):
+        '''
+        Analyses files, saving and using the results as they come in.
+        '''
+        keys = {key for key, _, _ in pending}
+        songs = [song for song in songs if song.key in keys]
+        start = time.perf_counter()
+        rows = []
+        count = 0
+
+        def save():
+            self.database.update_analysis(rows)
+            self.apply(songs, {key: (mtime, duration, gain) for key, mtime, duration, gain in rows})
+            rows.clear()
+
+        for count, row in enumerate(self.analyse_files(pending), 1):
+            rows.append(row)
+
+            if len(rows) >= SAVE_EVERY:
+                save()
+
+            if progress and len(pending) > 1:
+                elapsed = time.perf_counter() - start
+                print(f"\rAnalysed {count}/{len(pending)} songs ({count / elapsed:.1f} songs/s)", end="", flush=True)
+
+        save()
+
+        if progress and len(pending) > 1:
+            print()
+        elif not progress:
+            logging.info(f"Analysed {count}/{len(pending)} songs in the background in {time.perf_counter() - start:.1f}s")
+
+    def analyse_files(self, pending):
+        '''
+        Analyses files, yielding rows of key, modification time, duration and gain. Stops early if `close` is called.
+        '''
+        # Starting worker processes takes a while, so only do it if there's more than one file
+        if len(pending) == 1:
+            key, path, mtime = pending[0]
+            duration, gain, error = analyse_file(path)
+
+            if error:
+                logging.warning(f"Failed to analyse {path}: {error}")
+
+            yield key, mtime, duration, gain
+            return
+
+        executor = ProcessPoolExecutor(max_workers=self.options.workers)
+
+        try:
+            futures = {executor.submit(analyse_file, path): (key, path, mtime) for key, path, mtime in pending}
+
+            for future in as_completed(futures):
+                if self.stopped.is_set():
+                    return
+
+                key, path, mtime = futures[future]
+                duration, gain, error = future.result()
+
+                if error:
+                    logging.warning(f"Failed to analyse {path}: {error}")
+
+                yield key, mtime, duration, gain
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        '''
+        Stops a background pass, keeping the results it has so far. This needs to happen before the database is closed.
+        '''
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,213 @@
+'''
+Benchmarks for the parts of the player that get slow with big libraries.
+
+Synthetic AniSongDB lists and a synthetic songs directory are generated in a temporary directory, then each stage is
+timed. Results are printed as JSON, so runs on different commits can be compared with --compare.
+'''
+import argparse, contextlib, json, os, platform, random, subprocess, sys, tempfile, time
+from database import Database
+from index import FileIndex, get_index, indexes
+from options import Options
+from playlist import Playlist
+from tagging import Tagger
+
+def audio_name(number):
+    # Song files are named with six characters and an extension, like the real ones
+    return f"{number:06d}.mp3"
+
+def make_entry(number, rng):
+    anime = number // 5
+    return {
+        'animeENName': f"Anime {anime}",
+        'animeJPName': f"Anime JP {anime}",
+        'animeVintage': f"{rng.choice(['Winter', 'Spring', 'Summer', 'Fall'])} {2000 + anime % 25}",
+        'animeType': rng.choice(['TV', 'Movie', 'OVA']),
+        'songName': f"Song {number}",
+        'songArtist': f"Artist {number % 2000}",
+        'songType': rng.choice(['Opening 1', 'Ending 1', 'Insert Song']),
+        'songDifficulty': round(rng.uniform(0, 100), 1),
+        'audio': f"https://example.com/{audio_name(number)}",
+        'songLength': round(rng.uniform(60, 120), 2),
+        'annSongId': number,
+        'linked_ids': {'anilist': anime + 1, 'myanimelist': anime + 1, 'anidb': None, 'kitsu': None},
+        'composers': [{'names': [f"Composer {number % 500}"]}],
+        'arrangers': [{'names': [f"Arranger {number % 700}"]}],
+    }
+
+def write_lists(path, entries, files, overlap, rng):
+    '''
+    Writes `files` lists with `entries` entries in total, with `overlap` of the entries also appearing in other lists.
+    '''
+    os.makedirs(path, exist_ok=True)
+    unique = max(1, int(entries * (1 - overlap)))
+    pool = [make_entry(number, rng) for number in range(unique)]
+    per_file = entries // files
+
+    for index in range(files):
+        start = index * unique // files
+        file_entries = pool[start:start + per_file]
+        file_entries += rng.sample(pool, per_file - len(file_entries))
+
+        with open(os.path.join(path, f"list{index}.json"), 'w', encoding="utf-8") as f:
+            json.dump(file_entries, f)
+
+    return unique
+
+def write_songs(path, count, folders):
+    '''
+    Writes `count` fake mp3 files spread over `folders` subdirectories.
+    '''
+    for folder in range(folders):
+        os.makedirs(os.path.join(path, f"folder{folder}"), exist_ok=True)
+
+    # A frame header followed by silence is enough for tagging to work on
+    data = b"\xff\xfb\x90\x64" + bytes(413)
+
+    for number in range(count):
+        with open(os.path.join(path, f"folder{number % folders}", audio_name(number)), 'wb') as f:
+            f.write(data * 4)
+
+def timed(results, stage, count, function):
+    '''
+    Times a stage, recording how long it took and how many items per second it got through.
+    '''
+    start = time.perf_counter()
+    value = function()
+    elapsed = time.perf_counter() - start
+
+    results[stage] = {'seconds': round(elapsed, 6), 'items': count, 'items_per_second': round(count / elapsed, 1) if elapsed else None}
+    print(f"{stage:>16}: {elapsed:9.4f}s ({count} items)", file=sys.stderr)
+    return value
+
+def make_options(root):
+    options = Options()
+    options.lists = [os.path.join(root, "lists")]
+    options.songs_path = os.path.join(root, "data")
+    options.covers_path = os.path.join(root, "covers")
+    options.cache_path = os.path.join(root, "cache")
+    options.output = None
+    options.min_difficulty = 20
+    options.max_difficulty = 80
+    options.search_artists = ["artist 1"]
+    return options
+
+def run(entries, files, overlap, song_files, db_songs, tag_songs, seed):
+    rng = random.Random(seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as root:
+        options = make_options(root)
+
+        for path in (options.songs_path, options.covers_path, options.cache_path):
+            os.makedirs(path, exist_ok=True)
+
+        unique = write_lists(options.lists[0], entries, files, overlap, rng)
+        song_files = min(song_files, unique)
+        write_songs(options.songs_path, song_files, folders=20)
+
+        # Cold start, in a fresh interpreter so nothing is imported yet
+        timed(results, "import_player", 1, lambda: subprocess.run([sys.executable, "-c", "import player"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True))
+
+        # Path lookups
+        cache_file = os.path.join(root, "cache", "index.json")
+        timed(results, "index_build", song_files, lambda: FileIndex(options.songs_path, cache_file).load())
+        timed(results, "index_load", song_files, lambda: FileIndex(options.songs_path, cache_file).load())
+        indexes.clear()
+        get_index(options.songs_path, cache_file)
+
+        database = Database(os.path.join(root, "player.db"))
+        database.initalise()
+        playlist = Playlist(options, database)
+        files = playlist.find_files()
+
+        # Loading, the first time parsing everything and then from the list cache
+        songs = set()
+        timed(results, "load_uncached", entries, lambda: playlist.load_files(files, songs))
+        timed(results, "load_cached", entries, lambda: playlist.load_files(files, set()))
+
+        decoded = [song for file_songs in playlist.sources.values() for song in file_songs]
+        timed(results, "dedup", len(decoded), lambda: set(decoded))
+
+        songs = list(songs)
+        table, mask = timed(results, "filter", len(songs), lambda: playlist.filter(songs))
+        shuffled = list(songs)
+        timed(results, "shuffle", len(songs), lambda: rng.shuffle(shuffled))
+        timed(results, "path_lookup", len(songs), lambda: [song.file_path(options.songs_path) for song in songs])
+
+        # Play history, one song at a time like between songs, and all at once
+        history_songs = songs[:db_songs]
+
+        def update_loop():
+            for song in history_songs:
+                database.select(song)
+                database.update(song)
+
+        timed(results, "db_update_loop", len(history_songs), update_loop)
+        timed(results, "db_select_many", len(songs), lambda: database.select_many(songs))
+        database.close()
+
+        # Tagging, the first time and then with nothing to do
+        downloaded = [song for song in songs if song.is_downloaded(options.songs_path)][:tag_songs]
+        timed(results, "tagging", len(downloaded), lambda: Tagger(options).tag(downloaded))
+        timed(results, "tagging_skip", len(downloaded), lambda: Tagger(options).tag(downloaded))
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current):
+    '''
+    Prints how long each stage took compared to a previous run.
+    '''
+    print(f"Compared to {previous.get('commit')}:", file=sys.stderr)
+
+    for size, stages in current['results'].items():
+        for stage, result in stages.items():
+            before = previous['results'].get(size, {}).get(stage)
+
+            if before and before['seconds']:
+                print(f"{size:>8} {stage:>16}: {result['seconds'] / before['seconds']:6.2f}x", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks playlist loading, filtering, path lookups, database access and tagging")
+    parser.add_argument("--sizes", default=[10000, 100000], type=int, nargs='+', help="numbers of list entries to benchmark with")
+    parser.add_argument("--files", default=50, type=int, help="number of list files to split entries into")
+    parser.add_argument("--overlap", default=0.3, type=float, help="fraction of entries that appear in more than one list")
+    parser.add_argument("--song-files", default=20000, type=int, help="number of fake songs in the songs directory")
+    parser.add_argument("--db-songs", default=1000, type=int, help="number of songs to update in the database one at a time")
+    parser.add_argument("--tag-songs", default=500, type=int, help="number of songs to tag")
+    parser.add_argument("--seed", default=0, type=int, help="seed for generating data")
+    parser.add_argument("--output", type=str, help="file to write results to, instead of printing them")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare to")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {},
+    }
+
+    for size in args.sizes:
+        print(f"Benchmarking with {size} entries", file=sys.stderr)
+
+        # Keep stdout for the results, the player prints progress as it goes
+        with contextlib.redirect_stdout(sys.stderr):
+            report['results'][str(size)] = run(size, args.files, args.overlap, args.song_files, args.db_songs, args.tag_songs, args.seed)
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
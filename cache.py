@@ -0,0 +1,84 @@
+import logging, os
+from datetime import datetime
+from index import get_index
+
+class SongCache:
+    '''
+    Keeps the songs directory under a size limit by deleting songs we rarely play.
+
+    Songs are deleted in order of play count, then how long ago they were last played. Songs coming up soon in the
+    playlist are never deleted. Only files named after songs in the loaded lists count as songs, so partial downloads
+    and anything else kept in the songs directory are never counted or deleted.
+    '''
+    def __init__(self, options, database):
+        self.options = options
+        self.database = database
+        self.quota = options.songs_quota * 1024 * 1024
+        self.index = get_index(options.songs_path)
+        self.sizes = {}
+
+        # File names of every song in the loaded lists
+        self.keys = set()
+
+    def size(self):
+        '''
+        Gets the total size of the songs in the songs directory, only checking files we haven't seen yet.
+        '''
+        paths = {path for name, path in self.index.snapshot().items() if name in self.keys}
+
+        for path in self.sizes.keys() - paths:
+            del self.sizes[path]
+
+        for path in paths - self.sizes.keys():
+            try:
+                self.sizes[path] = os.path.getsize(path)
+            except OSError:
+                pass
+
+        return sum(self.sizes.values())
+
+    def report(self, songs):
+        '''
+        Shows how full the songs directory is, and how much of the playlist is already downloaded.
+        '''
+        size = self.size() / 1024 / 1024
+        limit = f"{self.quota / 1024 / 1024:.0f} MB" if self.quota else "unlimited"
+        cached = sum(1 for song in songs if song.is_downloaded(self.options.songs_path))
+        hit_rate = cached / len(songs) if songs else 0
+
+        print(f"Song cache: {size:.0f} MB used of {limit} ({len(self.sizes)} songs), {cached}/{len(songs)} songs in playlist already downloaded ({hit_rate:.0%})")
+
+    def evict(self, protected):
+        '''
+        Deletes songs until the songs directory fits in the quota, without touching the protected songs.
+        '''
+        if not self.quota:
+            return
+
+        total = self.size()
+
+        if total <= self.quota:
+            return
+
+        protected_paths = {os.path.normpath(song.file_path(self.options.songs_path)) for song in protected}
+        candidates = [path for path in self.sizes if path not in protected_paths]
+        history = self.database.select_keys({os.path.basename(path) for path in candidates})
+
+        # Least played first, then least recently played
+        def priority(path):
+            play_count, last_played = history.get(os.path.basename(path), (0, None))
+            return play_count, last_played or datetime.min
+
+        for path in sorted(candidates, key=priority):
+            if total <= self.quota:
+                break
+
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Failed to remove song {path}: {e}")
+                continue
+
+            logging.info(f"Removed song from cache: {path}")
+            total -= self.sizes.pop(path)
+            self.index.remove(path)
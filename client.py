@@ -0,0 +1,59 @@
+'''
+Controls a player running with `player daemon`.
+
+    python client.py status
+    python client.py skip|back|pause|stop|quit
+    python client.py playlist --search-artists "artist" --min-difficulty 30
+
+Options given to `playlist` are the same as the player's, and are applied on top of the options the daemon started with.
+'''
+import argparse, json, socket, sys
+from options import Options
+
+COMMANDS = ["status", "skip", "back", "pause", "stop", "playlist", "quit"]
+
+def send(socket_path, request):
+    '''
+    Sends a request to the daemon and waits for its response.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(str(socket_path))
+        connection.sendall(json.dumps(request).encode() + b"\n")
+
+        with connection.makefile('rb') as f:
+            return json.loads(f.readline())
+
+def main():
+    options = Options()
+    options.from_file("options.conf")
+
+    parser = argparse.ArgumentParser(description="controls a player running in daemon mode")
+    parser.add_argument("command", choices=COMMANDS, help="what to tell the player to do")
+    parser.add_argument("--socket-path", default=options.socket_path, help="socket the daemon is listening on")
+    args, rest = parser.parse_known_args()
+
+    if rest and args.command != "playlist":
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+
+    try:
+        response = send(args.socket_path, {'command': args.command, 'args': rest})
+    except OSError as e:
+        print(f"Could not connect to the player, is it running with `player daemon`? ({e})")
+        sys.exit(1)
+
+    if not response.get('ok'):
+        print(f"Error: {response.get('error')}")
+        sys.exit(1)
+
+    if args.command == "status":
+        if not response['playing']:
+            print(f"Not playing ({response['count']} songs in playlist)")
+        elif response['position'] is not None and response['duration']:
+            print(f"Playing: {response['song']} ({response['index']}/{response['count']}) {response['position']:.0f}/{response['duration']:.0f}s")
+        else:
+            print(f"Playing: {response['song']} ({response['index']}/{response['count']})")
+    elif args.command == "playlist":
+        print(f"Playing {response['count']} songs (built in {response['milliseconds']}ms)")
+
+if __name__ == "__main__":
+    main()
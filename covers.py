@@ -0,0 +1,346 @@
+import io, logging, os, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+def load_pillow():
+    '''
+    Imports Pillow, which is only needed to shrink covers, so it's fine if it isn't installed.
+    '''
+    try:
+        from PIL import Image
+        return Image
+    except ImportError:
+        return None
+
+ANILIST_URL = "https://graphql.anilist.co"
+
+# Anilist returns at most 50 results per page
+BATCH_SIZE = 50
+
+COVERS_QUERY = """
+    query ($ids: [Int], $perPage: Int) {
+        Page(perPage: $perPage) {
+            media(id_in: $ids, type: ANIME) {
+                id
+                coverImage {
+                    extraLarge
+                }
+            }
+        }
+    }
+"""
+
+class TokenBucket:
+    '''
+    Limits how often requests are made. The limits are updated from the rate limit headers of each response.
+    '''
+    def __init__(self, limit=30, period=60):
+        self.capacity = limit
+        self.rate = limit / period
+        self.period = period
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Waits until we're allowed to make a request.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def update(self, response):
+        '''
+        Adjusts the limits to what the server told us.
+        '''
+        with self.lock:
+            if 'X-RateLimit-Limit' in response.headers:
+                self.capacity = int(response.headers['X-RateLimit-Limit'])
+                self.rate = self.capacity / self.period
+
+            if 'X-RateLimit-Remaining' in response.headers:
+                self.tokens = min(self.tokens, int(response.headers['X-RateLimit-Remaining']))
+
+            if 'Retry-After' in response.headers:
+                try:
+                    retry_after = float(response.headers['Retry-After'])
+                except ValueError:
+                    retry_after = self.period
+
+                self.paused_until = time.monotonic() + retry_after
+                logging.warning(f"Anilist rate limit reached, waiting {retry_after} seconds")
+
+class CoverCache:
+    '''
+    Keeps recently used covers in memory, so songs from the same anime don't read and decode the same file again.
+
+    Covers larger than `max_size` pixels are shrunk before they're cached, and the covers directory is kept under
+    `quota` bytes by deleting the covers that were used least recently.
+    '''
+    def __init__(self, covers_path, memory_limit, quota=0, max_size=0):
+        self.covers_path = covers_path
+        self.memory_limit = memory_limit
+        self.quota = quota
+        self.max_size = max_size
+        self.covers = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.pillow = load_pillow() if max_size else None
+
+        if self.max_size and not self.pillow:
+            logging.warning("Pillow is not installed, covers will not be resized")
+
+    def get(self, path):
+        '''
+        Gets the mime type and data of a cover.
+        '''
+        with self.lock:
+            if path in self.covers:
+                self.covers.move_to_end(path)
+                return self.covers[path]
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        import filetype
+
+        data = self.shrink(data)
+        cover = filetype.guess_mime(data), data
+
+        # Remember when the cover was last used for the disk quota, without changing its modification time
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+        with self.lock:
+            if path not in self.covers:
+                self.covers[path] = cover
+                self.size += len(data)
+
+            while self.size > self.memory_limit and len(self.covers) > 1:
+                _, (_, evicted) = self.covers.popitem(last=False)
+                self.size -= len(evicted)
+
+        return cover
+
+    def shrink(self, data):
+        '''
+        Scales a cover down to fit within `max_size`, re-encoding it as a JPEG.
+        '''
+        if not self.max_size or not self.pillow:
+            return data
+
+        try:
+            image = self.pillow.open(io.BytesIO(data))
+
+            if max(image.size) <= self.max_size:
+                return data
+
+            image.thumbnail((self.max_size, self.max_size))
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=90)
+
+        except OSError as e:
+            logging.warning(f"Failed to resize cover: {e}")
+            return data
+
+        return output.getvalue()
+
+    def enforce_quota(self):
+        '''
+        Deletes the least recently used covers until the covers directory fits in the quota.
+        '''
+        if not self.quota:
+            return
+
+        covers = []
+
+        for entry in os.scandir(self.covers_path):
+            if entry.is_file():
+                stat = entry.stat()
+                covers.append((stat.st_atime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in covers)
+
+        for _, size, path in sorted(covers):
+            if total <= self.quota:
+                break
+
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Failed to remove cover {path}: {e}")
+                continue
+
+            logging.debug(f"Removed cover: {path}")
+            total -= size
+
+            with self.lock:
+                if path in self.covers:
+                    self.size -= len(self.covers.pop(path)[1])
+
+class CoverService:
+    '''
+    Downloads anime cover art from Anilist.
+
+    Covers are looked up many anime at a time, and each anime is only ever fetched once, even if many songs ask for it
+    at the same time. Images are downloaded in parallel.
+    '''
+    def __init__(self, covers_path, cache, url=ANILIST_URL, workers=4):
+        self.covers_path = covers_path
+        self.cache = cache
+        self.url = url
+        import requests
+
+        self.bucket = TokenBucket()
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="covers")
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def cover_path(self, id):
+        return os.path.join(self.covers_path, str(id))
+
+    def fetch(self, ids):
+        '''
+        Downloads the covers of anime we don't have yet, returning whether each cover is available.
+        '''
+        ids = set(ids)
+        claimed = []
+
+        # Claim the anime nobody else is fetching yet, and wait for the rest
+        with self.lock:
+            for id in ids:
+                if id not in self.pending and not os.path.exists(self.cover_path(id)):
+                    self.pending[id] = Future()
+                    claimed.append(id)
+
+            futures = {id: self.pending[id] for id in ids if id in self.pending}
+
+        claimed.sort()
+
+        for start in range(0, len(claimed), BATCH_SIZE):
+            batch = claimed[start:start + BATCH_SIZE]
+
+            try:
+                self.fetch_batch(batch)
+            except Exception as e:
+                logging.warning(f"Failed to fetch covers: {e}")
+
+                # Don't leave anyone waiting for covers that aren't coming
+                for id in batch:
+                    if not self.pending[id].done():
+                        self.pending[id].set_result(False)
+
+        for future in futures.values():
+            future.result()
+
+        with self.lock:
+            for id in claimed:
+                del self.pending[id]
+
+        if claimed:
+            self.cache.enforce_quota()
+
+        return {id: os.path.exists(self.cover_path(id)) for id in ids}
+
+    def read(self, id):
+        '''
+        Gets the mime type and data of a cover we have downloaded.
+        '''
+        return self.cache.get(self.cover_path(id))
+
+    def fetch_batch(self, ids):
+        '''
+        Looks up the cover urls of a batch of anime, then downloads the images.
+        '''
+        import requests
+
+        image_urls = {}
+
+        try:
+            while True:
+                self.bucket.acquire()
+                r = self.session.post(self.url, json={'query': COVERS_QUERY, 'variables': {'ids': ids, 'perPage': BATCH_SIZE}}, timeout=30)
+                self.bucket.update(r)
+
+                # Try again once the rate limit resets
+                if r.status_code != 429:
+                    break
+
+            if r.ok:
+                for media in r.json()['data']['Page']['media']:
+                    image_urls[media['id']] = media['coverImage']['extraLarge']
+            else:
+                logging.warning(f"Bad request for Anilist query: {r.status_code}")
+
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Anilist query failed: {e}")
+
+        downloads = {id: self.executor.submit(self.download, id, image_urls[id]) for id in ids if image_urls.get(id)}
+
+        for id in ids:
+            if id in downloads:
+                downloads[id].add_done_callback(lambda download, id=id: self.pending[id].set_result(download.result()))
+            else:
+                logging.warning(f"No cover found on Anilist: {id}")
+                self.pending[id].set_result(False)
+
+    def download(self, id, image_url):
+        '''
+        Downloads a cover image.
+        '''
+        import requests
+
+        try:
+            r = self.session.get(image_url, timeout=30)
+        except requests.RequestException as e:
+            logging.warning(f"Anilist image download failed: {e}")
+            return False
+
+        if not r.ok:
+            logging.warning(f"Bad request Anilist image query")
+            return False
+
+        # Write to a temporary file first, so nobody reads a half written cover
+        path = self.cover_path(id)
+
+        try:
+            with open(f"{path}.tmp", 'wb') as f:
+                logging.debug(f"Saving file: {path}")
+                f.write(r.content)
+
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logging.warning(f"Failed to save cover {path}: {e}")
+            return False
+
+        return True
+
+services = {}
+services_lock = threading.Lock()
+
+def get_cover_service(options):
+    '''
+    Gets the cover service for the covers directory.
+    '''
+    key = os.path.normpath(options.covers_path)
+
+    with services_lock:
+        if key not in services:
+            cache = CoverCache(key, options.cover_cache_size * 1024 * 1024, options.covers_quota * 1024 * 1024, options.cover_max_size)
+            services[key] = CoverService(key, cache, options.anilist_url)
+
+        return services[key]
@@ -0,0 +1,154 @@
+import copy, json, logging, os, socketserver, threading, time
+
+class Daemon:
+    '''
+    Keeps the player running in the background with everything loaded, controlled by client.py over a Unix socket.
+
+    Lists, the file index, the database connection and the search index stay in memory, so switching to a different
+    playlist only has to filter and shuffle songs again.
+
+    Requests and responses are one line of JSON each, like {"command": "playlist", "args": ["--search-artists", "x"]}.
+    '''
+    def __init__(self, options, playlist):
+        self.options = options
+        self.playlist = playlist
+        self.playlist.keep_search_index = True
+
+        # The daemon is controlled through its socket, and usually runs in the background where it can't use the terminal
+        self.playlist.use_terminal = False
+        self.running = True
+        self.playing = False
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.server = None
+
+    def run(self):
+        '''
+        Plays playlists until asked to quit, waiting for a new playlist whenever one ends.
+        '''
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+            print("Daemon mode needs Unix sockets, which aren't available on this system")
+            return
+
+        self.listen()
+        print(f"Listening for commands on {self.options.socket_path}")
+
+        try:
+            while self.running:
+                with self.lock:
+                    self.playing = self.playlist.count > 0
+                    self.wake.clear()
+
+                if self.playing:
+                    self.playlist.play()
+
+                with self.lock:
+                    self.playing = False
+
+                    # A playlist sent just as the last one ended hasn't been picked up yet
+                    if self.playlist.take_replacement():
+                        continue
+
+                if self.running:
+                    self.wake.wait()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+
+            if os.path.exists(self.options.socket_path):
+                os.remove(self.options.socket_path)
+
+    def listen(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    response = daemon.handle(request.get('command'), request.get('args', []))
+                except Exception as e:
+                    logging.warning(f"Failed to handle request: {e}")
+                    response = {'ok': False, 'error': str(e)}
+
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        # Left over from a daemon that didn't exit cleanly
+        if os.path.exists(self.options.socket_path):
+            os.remove(self.options.socket_path)
+
+        self.server = socketserver.ThreadingUnixStreamServer(os.fspath(self.options.socket_path), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="daemon", daemon=True).start()
+
+    def handle(self, command, args):
+        '''
+        Handles a request from the client, returning the response to send back.
+        '''
+        logging.debug(f"Daemon command: {command} {args}")
+
+        match command:
+            case 'status':
+                return self.status()
+            case 'skip':
+                self.playlist.controls.put(b'n')
+            case 'back':
+                self.playlist.controls.put(b'b')
+            case 'pause':
+                self.playlist.controls.put(b' ')
+            case 'stop':
+                self.playlist.controls.put(b'\x1b')
+            case 'playlist':
+                return self.new_playlist(args)
+            case 'quit':
+                self.running = False
+                self.playlist.controls.put(b'\x1b')
+                self.wake.set()
+            case _:
+                return {'ok': False, 'error': f"Unknown command: {command}"}
+
+        return {'ok': True}
+
+    def status(self):
+        player = self.playlist.player
+        song = self.playlist.songs[self.playlist.index] if self.playing and self.playlist.index < self.playlist.count else None
+
+        return {
+            'ok': True,
+            'playing': self.playing,
+            'song': song.full_name(self.playlist.options.prefer_english) if song else None,
+            'index': self.playlist.index + 1 if song else None,
+            'count': self.playlist.count,
+            'position': player.position if song and player else None,
+            'duration': player.duration if song and player else None,
+        }
+
+    def new_playlist(self, args):
+        '''
+        Builds a playlist from the daemon's options with `args` on top, and starts playing it.
+        '''
+        options = copy.copy(self.options)
+
+        # Bad arguments make argparse exit, which would take down the daemon
+        try:
+            options.from_options(args)
+        except SystemExit:
+            return {'ok': False, 'error': f"Invalid options: {' '.join(args)}"}
+
+        with self.build_lock:
+            start = time.perf_counter()
+            self.playlist.options = options
+            songs, duration = self.playlist.build(self.playlist.library())
+            elapsed = time.perf_counter() - start
+
+        print(f"New playlist of {len(songs)} songs, built in {elapsed * 1000:.0f}ms")
+
+        with self.lock:
+            if self.playing:
+                self.playlist.replace(songs, duration)
+            else:
+                self.playlist.songs[:], self.playlist.duration = songs, duration
+                self.playlist.count = len(songs)
+                self.wake.set()
+
+        return {'ok': True, 'count': len(songs), 'duration': duration, 'milliseconds': round(elapsed * 1000, 1)}
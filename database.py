@@ -1,69 +1,215 @@
-
-import logging, sqlite3
+import logging, sqlite3, threading
 from datetime import datetime
+from stats import stats
 
-class Connection:
-    def __init__(self, path):
-        self.connect = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+# SQLite limits how many parameters a query can have, so bulk queries are split into chunks of this size
+CHUNK_SIZE = 500
+
+# Version of the database layout, stored in SQLite's user_version so older databases can be upgraded
+SCHEMA_VERSION = 2
+
+UPDATE_SONG = """
+    INSERT INTO history
+    VALUES (?, 1, ?)
+    ON CONFLICT (key) DO
+    UPDATE SET
+        play_count = play_count + 1,
+        last_played = excluded.last_played
+"""
+
+SELECT_SONG = """
+    SELECT
+        play_count,
+        last_played
+    FROM history
+    WHERE key = ?
+"""
+
+SELECT_SONGS = """
+    SELECT
+        key,
+        play_count,
+        last_played
+    FROM history
+    WHERE key IN ({})
+"""
+
+SELECT_ANALYSIS = """
+    SELECT
+        key,
+        mtime_ns,
+        duration,
+        gain
+    FROM analysis
+    WHERE key IN ({})
+"""
+
+UPDATE_ANALYSIS = """
+    INSERT OR REPLACE INTO analysis
+    VALUES (?, ?, ?, ?)
+"""
+
+def hash_to_key(song_hash):
+    '''
+    Gets the key of a song from the hash older versions stored, which was made from the bytes of its audio file name.
+    '''
+    return song_hash.to_bytes((song_hash.bit_length() + 7) // 8).decode(errors="replace") + ".mp3"
+
+class Transaction:
+    def __init__(self, database):
+        self.database = database
 
     def __enter__(self):
-        return self.connect.cursor()
+        self.database.lock.acquire()
+
+        # Release the lock if we can't start, otherwise every other thread waits on it forever
+        try:
+            if not self.database.connection:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+            return self.database.connection.cursor()
+        except:
+            self.database.lock.release()
+            raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connect.commit()
-        self.connect.close()
+        try:
+            if exc_type:
+                self.database.connection.rollback()
+            else:
+                self.database.connection.commit()
+        finally:
+            self.database.lock.release()
 
 class Database:
     def __init__(self, path):
         self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
 
     def initalise(self):
-        with Connection(self.path) as con:
-            con.execute(
+        # Keep one connection open for the whole session, shared between threads one transaction at a time
+        self.connection = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+        with Transaction(self) as cursor:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+            if version < SCHEMA_VERSION:
+                self.migrate(cursor, version)
+
+        logging.debug("Initialised database")
+
+    def migrate(self, cursor, version):
+        '''
+        Upgrades the database to the current layout, keeping play history. Everything happens in one transaction, so
+        an interrupted upgrade leaves the old database as it was.
+        '''
+        cursor.execute("BEGIN")
+
+        if version < 1:
+            cursor.execute(
                 """
-                CREATE TABLE IF NOT EXISTS songs (
-                    hash int NOT NULL PRIMARY KEY,
+                CREATE TABLE history (
+                    key TEXT NOT NULL PRIMARY KEY,
                     play_count INTEGER NOT NULL,
                     last_played TIMESTAMP NOT NULL
                 )
                 """
             )
+            cursor.execute("CREATE INDEX history_last_played ON history (last_played)")
 
-        logging.debug("Initialised database")
+            # Songs used to be stored by a hash of their audio file name, which we can turn back into the name
+            if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs'").fetchone():
+                rows = cursor.execute("SELECT hash, play_count, last_played FROM songs WHERE hash != 0").fetchall()
+                cursor.executemany("INSERT OR IGNORE INTO history VALUES (?, ?, ?)", ((hash_to_key(song_hash), play_count, last_played) for song_hash, play_count, last_played in rows))
+                cursor.execute("DROP TABLE songs")
+                logging.info(f"Moved play history of {len(rows)} songs to the new database layout")
 
-    def update(self, song):
-        with Connection(self.path) as cursor:
-            now = datetime.now()
+        if version < 2:
             cursor.execute(
                 """
-                INSERT OR REPLACE INTO songs
-                VALUES (?, 1, ?)
-                ON CONFLICT (hash) DO
-                UPDATE SET
-                    play_count = play_count + 1,
-                    last_played = ?
-                """,
-                (hash(song), now, now)
+                CREATE TABLE analysis (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    duration REAL,
+                    gain REAL
+                )
+                """
             )
 
-        logging.debug(f"Updated database: {hash(song)}")
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        # Wait for a transaction on another thread to finish first
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
 
+    @stats.timed("db_update")
+    def update(self, song):
+        with Transaction(self) as cursor:
+            now = datetime.now()
+            cursor.execute(UPDATE_SONG, (song.key, now))
+
+        logging.debug(f"Updated database: {song.key}")
+
+    @stats.timed("db_select")
     def select(self, song):
-        with Connection(self.path) as cursor:
-            result = cursor.execute(
-                """
-                SELECT
-                    play_count,
-                    last_played
-                FROM songs
-                WHERE hash = ?
-                """,
-                (hash(song),)
-            ).fetchone()
+        with Transaction(self) as cursor:
+            result = cursor.execute(SELECT_SONG, (song.key,)).fetchone()
 
-        logging.debug(f"Retrieved from database: {hash(song)}: {result}")
+        logging.debug(f"Retrieved from database: {song.key}: {result}")
 
         if result:
             return result
 
         return 0, None
+
+    def select_many(self, songs):
+        '''
+        Gets play history for many songs at once. Songs that have never been played are left out.
+        '''
+        return self.select_keys({song.key for song in songs})
+
+    @stats.timed("db_select_many")
+    def select_keys(self, keys):
+        '''
+        Gets play history for many song keys at once. Songs that have never been played are left out.
+        '''
+        keys = list(keys)
+        results = {key: (play_count, last_played) for key, play_count, last_played in self.select_in(SELECT_SONGS, keys)}
+
+        logging.debug(f"Retrieved from database: {len(results)}/{len(keys)} songs")
+        return results
+
+    def select_in(self, query, keys):
+        '''
+        Runs a query for many keys, a chunk at a time.
+        '''
+        rows = []
+
+        with Transaction(self) as cursor:
+            for start in range(0, len(keys), CHUNK_SIZE):
+                chunk = keys[start:start + CHUNK_SIZE]
+                rows += cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+
+        return rows
+
+    def select_analysis(self, keys):
+        '''
+        Gets the modification time, duration and gain saved for many song keys at once.
+        '''
+        keys = list(keys)
+        return {key: (mtime_ns, duration, gain) for key, mtime_ns, duration, gain in self.select_in(SELECT_ANALYSIS, keys)}
+
+    def update_analysis(self, rows):
+        '''
+        Saves the results of analysing songs, as rows of key, modification time, duration and gain.
+        '''
+        with Transaction(self) as cursor:
+            cursor.executemany(UPDATE_ANALYSIS, rows)
+
+        logging.debug(f"Updated analysis in database: {len(rows)} songs")
@@ -0,0 +1,77 @@
+import itertools, logging, threading, time
+
+class Dispatcher:
+    '''
+    Runs the side effects of changing songs on a background thread, so they never hold up playback.
+
+    Updates with a name replace any update with the same name that hasn't run yet, so skipping through songs quickly
+    only writes the latest one. Named updates can also be limited to running once every so often.
+    '''
+    def __init__(self, intervals=None):
+        self.intervals = intervals or {}
+        self.last_run = {}
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.closing = False
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self.run, name="dispatcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, name=None):
+        '''
+        Queues a function to run in the background. Without a name, it always runs, in the order it was submitted.
+        '''
+        with self.condition:
+            key = name if name is not None else next(self.counter)
+
+            # Replaced updates keep their place in line, so a busy name can't be pushed back forever
+            self.pending[key] = function, args
+            self.condition.notify()
+
+    def next_due(self, now):
+        '''
+        Gets the first update that is allowed to run, or how long until one is.
+        '''
+        wait = None
+
+        for key in self.pending:
+            ready_at = self.last_run.get(key, 0) + self.intervals.get(key, 0)
+
+            if self.closing or ready_at <= now:
+                return key, None
+
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    key, wait = self.next_due(time.monotonic())
+
+                    if key is not None:
+                        break
+
+                    if self.closing:
+                        return
+
+                    self.condition.wait(wait)
+
+                function, args = self.pending.pop(key)
+                self.last_run[key] = time.monotonic()
+
+            try:
+                function(*args)
+            except Exception as e:
+                logging.warning(f"Failed to run {getattr(function, '__name__', function)} in the background: {e}")
+
+    def close(self, timeout=2):
+        '''
+        Runs anything still waiting, ignoring rate limits, then stops the background thread.
+        '''
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+
+        self.thread.join(timeout)
@@ -0,0 +1,170 @@
+import logging, time
+import numpy as np
+from index import get_index
+from stats import stats
+from table import vintage
+
+# Rough cost of checking one song in each kind of stage, relative to comparing a column
+COLUMN_COST = 1
+LOOKUP_COST = 20
+
+# Searching scans the text of every song left, unless the daemon has kept a search index around
+SEARCH_COST = 30
+INDEXED_SEARCH_COST = 1
+
+class Stage:
+    '''
+    One check in a filter plan. `apply` is given the song table and a mask of the songs still left, and returns a mask
+    of the songs that pass. Songs that are already filtered out don't need to be checked.
+
+    `selectivity` is a guess at the fraction of songs that pass, used along with `cost` to order stages.
+    '''
+    def __init__(self, name, cost, selectivity, apply):
+        self.name = name
+        self.cost = cost
+        self.selectivity = selectivity
+        self.apply = apply
+
+        # How the stage went the last time the plan ran
+        self.songs_in = 0
+        self.songs_out = 0
+        self.seconds = 0.0
+
+    @property
+    def rank(self):
+        # Checks that are cheap and filter out many songs go first
+        return self.cost / max(1 - self.selectivity, 0.01)
+
+class FilterPlan:
+    '''
+    Filters songs with a list of stages, ordered so cheap checks that remove many songs run before expensive ones, like
+    searching and looking for files, which then only have to look at what's left.
+    '''
+    def __init__(self, stages):
+        self.stages = sorted(stages, key=lambda stage: stage.rank)
+        self.total = 0
+
+    def run(self, table):
+        '''
+        Gets a mask of the songs in a table that pass every stage.
+        '''
+        mask = table.all()
+        self.total = len(table)
+
+        for stage in self.stages:
+            start = time.perf_counter()
+            stage.songs_in = int(np.count_nonzero(mask))
+
+            if stage.songs_in:
+                mask &= stage.apply(table, mask)
+
+            stage.songs_out = int(np.count_nonzero(mask))
+            stage.seconds = time.perf_counter() - start
+            stats.record(f"filter_{stage.name}", stage.seconds)
+
+        return mask
+
+    def explain(self):
+        '''
+        Describes the plan and how each stage went the last time it ran.
+        '''
+        lines = [f"Filter plan for {self.total} songs:"]
+        lines.append(f"  {'stage':<12} {'cost':>6} {'songs in':>9} {'songs out':>9} {'time':>10}")
+
+        for stage in self.stages:
+            lines.append(f"  {stage.name:<12} {stage.cost:>6} {stage.songs_in:>9} {stage.songs_out:>9} {stage.seconds * 1000:>8.2f}ms")
+
+        if not self.stages:
+            lines.append("  no filters, every song is played")
+
+        return "\n".join(lines)
+
+def difficulty_stage(options):
+    low = options.min_difficulty
+    high = options.max_difficulty
+
+    def apply(table, mask):
+        result = table.all()
+
+        if low:
+            result &= low <= table.difficulty
+        if high:
+            result &= table.difficulty <= high
+
+        return result
+
+    # Difficulties are spread over 0 to 100
+    selectivity = ((high or 100) - (low or 0)) / 100
+    return Stage("difficulty", COLUMN_COST, min(max(selectivity, 0), 1), apply)
+
+def song_type_stage(options):
+    # Song types are like "Opening 1" or "Insert Song", so "opening" matches every opening
+    types = [song_type.lower() for song_type in options.song_types]
+
+    def apply(table, mask):
+        return table.category_mask(table.song_type, lambda value: (value or "").lower().startswith(tuple(types)))
+
+    return Stage("song_type", COLUMN_COST, min(len(types) * 0.35, 1), apply)
+
+def anime_type_stage(options):
+    types = {anime_type.lower() for anime_type in options.anime_types}
+
+    def apply(table, mask):
+        return table.category_mask(table.anime_type, lambda value: (value or "").lower() in types)
+
+    return Stage("anime_type", COLUMN_COST, min(len(types) * 0.3, 1), apply)
+
+def vintage_stage(options):
+    low = vintage(options.min_vintage) if options.min_vintage else None
+    high = vintage(options.max_vintage) if options.max_vintage else None
+
+    for name, value, parsed in (("min_vintage", options.min_vintage, low), ("max_vintage", options.max_vintage, high)):
+        if value and not parsed:
+            logging.warning(f"Ignoring invalid value for option {name}: '{value}'")
+
+    if not low and not high:
+        return None
+
+    def apply(table, mask):
+        result = table.all()
+
+        # A range includes every season of the years it starts and ends in
+        if low:
+            result &= low[0] <= table.vintage
+        if high:
+            result &= table.vintage <= high[1]
+
+        return result
+
+    return Stage("vintage", COLUMN_COST, 0.3, apply)
+
+def downloaded_stage(options):
+    def apply(table, mask):
+        # Look songs up in the file index all at once, instead of finding the index again for every song
+        files = get_index(options.songs_path).files
+        return table.mask(lambda song: song.audio in files, where=mask)
+
+    return Stage("downloaded", LOOKUP_COST, 0.5, apply)
+
+def filter_stages(options):
+    '''
+    Gets the stages for the filters set in the options, apart from searching, which needs the playlist's search index.
+    '''
+    stages = []
+
+    if options.min_difficulty or options.max_difficulty:
+        stages.append(difficulty_stage(options))
+
+    if options.song_types:
+        stages.append(song_type_stage(options))
+
+    if options.anime_types:
+        stages.append(anime_type_stage(options))
+
+    if options.min_vintage or options.max_vintage:
+        stages.append(vintage_stage(options))
+
+    if options.offline_mode:
+        stages.append(downloaded_stage(options))
+
+    return [stage for stage in stages if stage]
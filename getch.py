@@ -1,13 +1,63 @@
+import atexit, os, sys, time
 
-import msvcrt, time
+if os.name == 'nt':
+    import msvcrt
 
-def getch_or_timeout(timeout):
-    '''
-    Waits for `timeout` seconds to check for a user input
-    '''
-    time.sleep(timeout)
+    # How often to check for key presses, short enough that waiting feels instant
+    POLL_INTERVAL = 0.01
 
-    if msvcrt.kbhit():
-        return msvcrt.getch()
+    def getch_or_timeout(timeout):
+        '''
+        Waits up to `timeout` seconds for a user input, returning as soon as there is one
+        '''
+        deadline = time.monotonic() + timeout
 
-    return
+        while True:
+            if msvcrt.kbhit():
+                return msvcrt.getch()
+
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                return
+
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+else:
+    import select, termios, tty
+
+    # Terminal settings from before we started reading single keys, restored when we exit
+    original_settings = None
+
+    def restore_terminal():
+        termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, original_settings)
+
+    def setup_terminal(fd):
+        '''
+        Makes key presses readable as soon as they happen, instead of after enter is pressed.
+        '''
+        global original_settings
+
+        if original_settings is None:
+            original_settings = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+            atexit.register(restore_terminal)
+
+    def getch_or_timeout(timeout):
+        '''
+        Waits up to `timeout` seconds for a user input, returning as soon as there is one
+        '''
+        fd = sys.stdin.fileno()
+
+        # Without a terminal there aren't any keys to read
+        if not os.isatty(fd):
+            time.sleep(timeout)
+            return
+
+        setup_terminal(fd)
+        ready, _, _ = select.select([fd], [], [], timeout)
+
+        if ready:
+            return os.read(fd, 1)
+
+        return
@@ -1,6 +1,185 @@
+import contextlib, json, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Number of failures in a row before we stop trying a host for a while
+MAX_FAILURES = 3
+# How long to skip a failing host for, doubled for every further failure
+COOLDOWN = 60
+MAX_COOLDOWN = 3600
+
+class HostManager:
+    '''
+    Tracks how well each host has been working, so the fastest healthy host is tried first.
+    '''
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.stats = {host: {'successes': 0, 'failures': 0, 'latency': None, 'failures_in_a_row': 0, 'skip_until': 0} for host in hosts}
+        self.stats_file = None
+        self.lock = threading.Lock()
+
+        # Limits on how many downloads each host serves at once, if any
+        self.slots = {}
+
+    def __iter__(self):
+        return iter(self.ranked())
+
+    def score(self, host):
+        '''
+        Gets the expected time to get a response from a host, lower is better.
+        '''
+        stats = self.stats[host]
+        success_rate = (stats['successes'] + 1) / (stats['successes'] + stats['failures'] + 2)
+        # Hosts we haven't heard from yet are assumed to be reasonably quick, so they get a chance
+        latency = stats['latency'] if stats['latency'] is not None else 0.5
+        return latency / success_rate
+
+    def ranked(self):
+        '''
+        Gets healthy hosts ordered from best to worst. If every host is failing, all of them are returned.
+        '''
+        with self.lock:
+            now = time.time()
+            healthy = [host for host in self.hosts if self.stats[host]['skip_until'] <= now]
+
+            if not healthy:
+                return sorted(self.hosts, key=lambda host: self.stats[host]['skip_until'])
+
+            return sorted(healthy, key=self.score)
+
+    def limit(self, connections):
+        '''
+        Limits how many downloads can use each host at once. 0 means no limit.
+        '''
+        self.slots = {host: threading.BoundedSemaphore(connections) for host in self.hosts} if connections else {}
+
+    def slot(self, host):
+        '''
+        Waits for a host to have room for another download, for use in a `with` statement.
+        '''
+        return self.slots.get(host) or contextlib.nullcontext()
+
+    def race(self, file_name):
+        '''
+        Asks the best two hosts for a file at the same time, and puts whichever has it first at the front.
+        '''
+        import requests
+
+        ranked = self.ranked()
+        contenders = ranked[:2]
+
+        def check(host):
+            r = get_session(host).head(host + file_name, timeout=10)
+            self.record_response(host, r)
+            return r.ok
+
+        if len(contenders) < 2:
+            return ranked
+
+        # Don't wait for the slower host once we have a winner
+        executor = ThreadPoolExecutor(max_workers=len(contenders))
+        futures = {executor.submit(check, host): host for host in contenders}
+        executor.shutdown(wait=False)
+
+        for future in as_completed(futures):
+            host = futures[future]
+
+            try:
+                if future.result():
+                    logging.debug(f"Host won race: {host}")
+                    return [host] + [other for other in ranked if other != host]
+            except requests.RequestException as e:
+                self.record_failure(host)
+                logging.debug(f"Host failed race: {host}: {e}")
+
+        return ranked
+
+    def record_response(self, host, response):
+        '''
+        Records a response from a host. Missing files are fine, since hosts can be out of date, but server errors are not.
+        '''
+        if response.status_code >= 500:
+            self.record_failure(host)
+        else:
+            self.record_success(host, response.elapsed.total_seconds())
+
+    def record_success(self, host, latency):
+        '''
+        Records a response from a host, keeping a moving average of its latency.
+        '''
+        with self.lock:
+            stats = self.stats[host]
+            stats['successes'] += 1
+            stats['failures_in_a_row'] = 0
+            stats['skip_until'] = 0
+            stats['latency'] = latency if stats['latency'] is None else 0.8 * stats['latency'] + 0.2 * latency
+
+    def record_failure(self, host):
+        '''
+        Records a host failing to respond, skipping it for a while if it keeps failing.
+        '''
+        with self.lock:
+            stats = self.stats[host]
+            stats['failures'] += 1
+            stats['failures_in_a_row'] += 1
+
+            if stats['failures_in_a_row'] >= MAX_FAILURES:
+                cooldown = min(COOLDOWN * 2 ** (stats['failures_in_a_row'] - MAX_FAILURES), MAX_COOLDOWN)
+                stats['skip_until'] = time.time() + cooldown
+                logging.warning(f"Skipping host for {cooldown} seconds: {host}")
+
+    def load_stats(self, stats_file):
+        '''
+        Loads host stats saved by a previous run.
+        '''
+        self.stats_file = stats_file
+
+        try:
+            with open(stats_file, 'r', encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Could not load host stats {stats_file}: {e}")
+            return
+
+        with self.lock:
+            for host, stats in saved.items():
+                if host in self.stats:
+                    self.stats[host].update(stats)
+
+    def save_stats(self):
+        '''
+        Saves host stats for the next run.
+        '''
+        if not self.stats_file:
+            return
+
+        with self.lock:
+            try:
+                with open(self.stats_file, 'w', encoding="utf-8") as f:
+                    json.dump(self.stats, f)
+            except OSError as e:
+                logging.warning(f"Failed to save host stats {self.stats_file}: {e}")
 
 def load_hosts():
     with open("hosts", 'r') as f:
-        return [line.strip() for line in f.readlines()]
+        return [line.strip() for line in f.readlines() if line.strip()]
+
+hosts = HostManager(load_hosts())
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(host):
+    '''
+    Gets a session for a host, so connections to it are kept open and reused between downloads.
+    '''
+    # requests takes a while to import, so only load it once we actually download something
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with sessions_lock:
+        if host not in sessions:
+            session = requests.Session()
+            session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=8))
+            sessions[host] = session
 
-hosts = load_hosts()
+        return sessions[host]
@@ -0,0 +1,188 @@
+import json, logging, os, threading
+
+class FileIndex:
+    '''
+    Maps audio file names to their paths inside a songs directory.
+
+    The index is saved to disk along with the modification time of every directory it has seen. On load, only
+    directories whose modification time has changed are scanned again, so we don't walk the whole tree every run.
+
+    Downloads add files from other threads, so anything that changes or goes through every file holds the lock.
+    Looking up a single file doesn't need it.
+    '''
+    def __init__(self, root, cache_file=None):
+        self.root = os.path.normpath(root)
+        self.cache_file = cache_file
+        self.files = {}
+        self.dirs = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def load(self):
+        '''
+        Loads the index from the cache file, then rescans any directories that have changed since.
+        '''
+        if self.cache_file:
+            try:
+                with open(self.cache_file, 'r', encoding="utf-8") as f:
+                    data = json.load(f)
+
+                if data['root'] == self.root:
+                    self.files = data['files']
+                    self.dirs = data['dirs']
+
+            except (OSError, ValueError, KeyError) as e:
+                logging.debug(f"Could not load file index {self.cache_file}: {e}")
+
+        self.refresh()
+        self.save()
+        logging.debug(f"Loaded file index: {len(self.files)} files in {len(self.dirs)} directories")
+
+    def refresh(self):
+        '''
+        Rescans directories that were added, removed or modified since they were last scanned.
+        '''
+        with self.lock:
+            stale = []
+
+            for dir, mtime in self.dirs.items():
+                try:
+                    if os.stat(dir).st_mtime_ns != mtime:
+                        stale.append(dir)
+                except OSError:
+                    stale.append(dir)
+
+            self.forget(stale)
+
+            # A directory we've never seen before is always stale, this also covers the first run
+            if self.root not in self.dirs:
+                stale.append(self.root)
+
+            for dir in stale:
+                if dir not in self.dirs and os.path.isdir(dir):
+                    self.scan(dir)
+
+    def forget(self, dirs):
+        '''
+        Removes directories and their files from the index. Subdirectories are kept, since they have their own entries.
+        '''
+        if not dirs:
+            return
+
+        dirs = set(dirs)
+
+        for dir in dirs:
+            self.dirs.pop(dir, None)
+
+        self.files = {name: path for name, path in self.files.items() if os.path.dirname(path) not in dirs}
+        self.dirty = True
+
+    def scan(self, dir):
+        '''
+        Adds the files of a directory to the index, descending into subdirectories we haven't indexed yet.
+        '''
+        try:
+            self.dirs[dir] = os.stat(dir).st_mtime_ns
+            entries = list(os.scandir(dir))
+        except OSError as e:
+            logging.warning(f"Failed to scan {dir}: {e}")
+            return
+
+        for entry in entries:
+            if entry.is_dir():
+                if entry.path not in self.dirs:
+                    self.scan(entry.path)
+            # Keep the first match, like the recursive search we used to do
+            elif entry.name not in self.files:
+                self.files[entry.name] = entry.path
+
+        self.dirty = True
+
+    def add(self, path):
+        '''
+        Adds a newly written file to the index.
+        '''
+        path = os.path.normpath(path)
+        dir = os.path.dirname(path)
+
+        with self.lock:
+            self.files[os.path.basename(path)] = path
+
+            # The directory changed because of us, so there's no need to rescan it next time
+            if dir in self.dirs:
+                self.dirs[dir] = os.stat(dir).st_mtime_ns
+
+            self.dirty = True
+
+    def remove(self, path):
+        '''
+        Removes a deleted file from the index.
+        '''
+        path = os.path.normpath(path)
+        dir = os.path.dirname(path)
+
+        with self.lock:
+            if self.files.get(os.path.basename(path)) == path:
+                del self.files[os.path.basename(path)]
+
+            if dir in self.dirs and os.path.isdir(dir):
+                self.dirs[dir] = os.stat(dir).st_mtime_ns
+
+            self.dirty = True
+
+    def path(self, name):
+        '''
+        Gets the path of a file, or where it should be saved to if we don't have it.
+        '''
+        return self.files.get(name) or os.path.join(self.root, name)
+
+    def snapshot(self):
+        '''
+        Gets a copy of the file names and paths in the index, which is safe to go through while downloads add files.
+        '''
+        with self.lock:
+            return dict(self.files)
+
+    def save(self):
+        '''
+        Saves the index to the cache file if anything changed.
+        '''
+        if not self.cache_file or not self.dirty:
+            return
+
+        with self.lock:
+            data = {'root': self.root, 'files': dict(self.files), 'dirs': dict(self.dirs)}
+            self.dirty = False
+
+        try:
+            with open(self.cache_file, 'w', encoding="utf-8") as f:
+                json.dump(data, f)
+        except OSError as e:
+            logging.warning(f"Failed to save file index {self.cache_file}: {e}")
+
+            with self.lock:
+                self.dirty = True
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+def get_index(root, cache_file=None):
+    '''
+    Gets the file index of a directory, building it on first use.
+    '''
+    key = os.path.normpath(root)
+
+    # Only one thread builds each index, the others wait for it
+    with indexes_lock:
+        if key not in indexes:
+            index = FileIndex(key, cache_file)
+            index.load()
+            indexes[key] = index
+
+        return indexes[key]
@@ -0,0 +1,65 @@
+import hashlib, json, logging, os, pickle
+from songs import Song
+
+# Bump this whenever Song changes, so we don't load songs cached in an old format
+CACHE_VERSION = 2
+
+def decode_file(file):
+    '''
+    Decodes a anisongdb json file into songs. This runs in worker processes, so errors are returned instead of logged.
+    '''
+    try:
+        with open(file, 'r', encoding="utf-8") as f:
+            anisong_json = json.load(f)
+
+        return [Song.decode(entry) for entry in anisong_json], None
+
+    except Exception as e:
+        return None, str(e)
+
+class ListCache:
+    '''
+    Stores decoded songs of each list file, so unchanged files don't need to be parsed again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def cache_file(self, file):
+        name = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+        return os.path.join(self.path, f"{name}.pickle")
+
+    @staticmethod
+    def key(file):
+        stat = os.stat(file)
+        return CACHE_VERSION, stat.st_size, stat.st_mtime_ns
+
+    def get(self, file):
+        '''
+        Gets the cached songs of a file, or None if the file changed since it was cached.
+        '''
+        try:
+            with open(self.cache_file(file), 'rb') as f:
+                key, songs = pickle.load(f)
+
+            if key != self.key(file):
+                return None
+
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError, TypeError):
+            return None
+
+        return songs
+
+    def set(self, file, songs):
+        '''
+        Caches the songs of a file.
+        '''
+        cache_file = self.cache_file(file)
+        temp_file = f"{cache_file}.tmp"
+
+        try:
+            with open(temp_file, 'wb') as f:
+                pickle.dump((self.key(file), songs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            logging.warning(f"Failed to cache {file}: {e}")
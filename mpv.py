@@ -0,0 +1,216 @@
+import json, logging, os, queue, shlex, socket, subprocess, tempfile, threading, time
+from getch import getch_or_timeout
+from stats import stats
+
+def encode(*command):
+    return json.dumps({'command': list(command)}).encode() + b"\n"
+
+class MpvPlayer:
+    '''
+    Plays songs through a single mpv process, controlled through its JSON IPC interface.
+
+    The next song is appended to mpv's playlist while the current one plays, so mpv can preload it and move on
+    without a gap. End of file and position updates come from mpv events instead of waiting for the process to exit.
+    '''
+    def __init__(self, command, gains=None, controls=None, terminal=True):
+        self.command = command
+
+        # Keys sent from somewhere other than the terminal, like the daemon, and whether to read keys from the terminal.
+        # A daemon running in the background would be stopped by the shell for touching the terminal.
+        self.controls = controls
+        self.terminal = terminal
+
+        # How many dB to adjust the volume of each file by, by file name
+        self.gains = gains if gains is not None else {}
+        self.process = None
+        self.reader = None
+        self.writer = None
+        self.write_lock = threading.Lock()
+
+        # Playback state, updated from mpv events
+        self.current_id = None
+        self.finished = threading.Event()
+        self.queued = None
+        self.position = None
+        self.duration = None
+
+        if os.name == 'nt':
+            self.ipc_path = rf"\\.\pipe\unnamed-anime-song-player-{os.getpid()}"
+        else:
+            self.ipc_path = os.path.join(tempfile.gettempdir(), f"unnamed-anime-song-player-{os.getpid()}.sock")
+
+    @stats.timed("player_start")
+    def start(self):
+        '''
+        Starts mpv and connects to it.
+        '''
+        args = shlex.split(self.command, posix=os.name != 'nt') + [
+            "--idle=yes",
+            "--no-terminal",
+            "--gapless-audio=weak",
+            "--prefetch-playlist=yes",
+            f"--input-ipc-server={self.ipc_path}",
+        ]
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # mpv takes a moment to create the IPC server
+        deadline = time.time() + 5
+
+        while True:
+            try:
+                self.connect()
+                break
+            except OSError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.process.kill()
+                    raise
+                time.sleep(0.05)
+
+        # mpv only sends property changes to the client that asked for them. On Windows the pipes we read from and write
+        # to are separate clients, so ask on the one we read events from, before anything starts reading it.
+        events = self.reader if os.name == 'nt' else self.writer
+
+        for id, name in enumerate(("time-pos", "duration"), 1):
+            events.write(encode("observe_property", id, name))
+
+        threading.Thread(target=self.read_events, daemon=True).start()
+        logging.debug(f"Started mpv: {self.ipc_path}")
+
+    def connect(self):
+        if os.name == 'nt':
+            # Reads and writes on the same synchronous pipe handle block each other, so commands go through one pipe and
+            # events are read from the other, which is only written to before reading starts
+            self.reader = open(self.ipc_path, 'r+b', buffering=0)
+            self.writer = open(self.ipc_path, 'r+b', buffering=0)
+            threading.Thread(target=self.drain, daemon=True).start()
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.ipc_path)
+            self.reader = connection.makefile('rb', buffering=0)
+            self.writer = connection.makefile('wb', buffering=0)
+
+    def send(self, *command):
+        '''
+        Sends a command to mpv.
+        '''
+        with self.write_lock:
+            self.writer.write(encode(*command))
+
+    def read_events(self):
+        '''
+        Reads messages from mpv and updates the playback state.
+        '''
+        for line in self.reader:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+
+            match message.get('event'):
+                case 'start-file':
+                    # `play` resets finished itself, clearing it here could lose the end of a file we just skipped
+                    self.current_id = message.get('playlist_entry_id')
+                case 'end-file':
+                    if message.get('playlist_entry_id') == self.current_id:
+                        logging.debug(f"mpv finished playing: {message.get('reason')}")
+                        self.finished.set()
+                case 'property-change' if message.get('name') == 'time-pos':
+                    self.position = message.get('data')
+                case 'property-change' if message.get('name') == 'duration':
+                    self.duration = message.get('data')
+
+        # mpv has exited, so nothing else is going to play
+        self.finished.set()
+
+    def drain(self):
+        '''
+        Throws away replies sent to the command pipe, so mpv never blocks writing to it.
+        '''
+        for _ in self.writer:
+            pass
+
+    def play(self, path, next_path=None):
+        '''
+        Plays a file until it ends or the user does something, then returns what to do next.
+        '''
+        path = os.fspath(path)
+
+        if path == self.queued:
+            # mpv has moved on to the file we queued by itself, so drop the songs that already played
+            self.finished.clear()
+            self.send("playlist-clear")
+        else:
+            self.current_id = None
+            self.finished.clear()
+            self.load(path, "replace")
+
+        self.queued = None
+
+        # Give mpv the next file early, so it can start it without a gap
+        if next_path:
+            self.queued = os.fspath(next_path)
+            self.load(self.queued, "append")
+
+        while not self.finished.is_set():
+            char = getch_or_timeout(0.05) if self.terminal else None
+
+            if char is None and self.controls:
+                # Without a terminal, waiting for controls takes the place of waiting for a key
+                try:
+                    char = self.controls.get(block=not self.terminal, timeout=0.05)
+                except queue.Empty:
+                    pass
+            elif char is None and not self.terminal:
+                self.finished.wait(0.05)
+
+            match char:
+                case b'q' | b'n':
+                    self.skip()
+                    return "next"
+                case b'b':
+                    return "back"
+                case b'\x1b':
+                    self.send("stop")
+                    self.finished.wait(timeout=1)
+                    return "quit"
+                case b' ':
+                    self.send("cycle", "pause")
+                case b'9':
+                    self.send("add", "volume", -2)
+                case b'0':
+                    self.send("add", "volume", 2)
+
+        return "next"
+
+    def load(self, path, flags):
+        '''
+        Loads a file into mpv's playlist. Its volume gain is given as an option of the file itself, so it applies from the
+        very start, instead of after mpv reports that the file changed.
+        '''
+        gain = self.gains.get(os.path.basename(path), 0)
+        self.send("loadfile", path, flags, -1, f"volume-gain={gain}")
+
+    def skip(self):
+        '''
+        Moves on to the queued file, or stops if there isn't one.
+        '''
+        self.send("playlist-next", "force")
+
+        # Wait for mpv to finish the current file, so its end doesn't get mistaken for the end of the next one
+        self.finished.wait(timeout=1)
+
+    def close(self):
+        '''
+        Stops mpv.
+        '''
+        if not self.process:
+            return
+
+        try:
+            self.send("quit")
+            self.process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+        if os.name != 'nt' and os.path.exists(self.ipc_path):
+            os.remove(self.ipc_path)
@@ -4,24 +4,56 @@ from pathlib import Path
 
 class Options:
     def __init__(self):
+        self.command = "play"
         self.lists = []
         self.player = "mpv --no-video"
         self.output = Path(r"skins\CurrentlyPlaying\CurrentlyPlaying.txt")
         self.songs_path = Path("data")
         self.covers_path = Path("covers")
+        self.cache_path = Path("cache")
+        self.socket_path = Path("player.sock")
+        self.serve_host = "127.0.0.1"
+        self.serve_port = 0
         self.prefer_english = False
         self.offline_mode = False
         self.log_level = "WARNING"
         self.min_difficulty = None
         self.max_difficulty = None
+        self.song_types = []
+        self.anime_types = []
+        self.min_vintage = None
+        self.max_vintage = None
         self.search_artists = []
         self.search_anime = []
+        self.search_titles = []
+        self.search_composers = []
+        self.search_arrangers = []
         self.exact_search = False
+        self.prefix_search = False
+        self.search_any = False
         self.copyright_as_album = False
         self.update_metadata = False
         self.start_with_unplayed = False
+        self.spaced_repetition = False
         self.enable_discord_rpc = False
         self.include_cover_art = False
+        self.prefetch_count = 3
+        self.workers = 4
+        self.songs_quota = 0
+        self.cover_cache_size = 64
+        self.covers_quota = 0
+        self.cover_max_size = 0
+        self.anilist_url = "https://graphql.anilist.co"
+        self.race_hosts = False
+        self.persistent_player = False
+        self.watch_lists = False
+        self.analyse_audio = False
+        self.normalise_volume = False
+        self.host_connections = 2
+        self.sync_retries = 3
+        self.explain_filters = False
+        self.show_stats = False
+        self.profile = None
 
     def from_file(self, file_path):
         '''
@@ -44,16 +76,19 @@ class Options:
                 try:
                     match key.lower():
                         # String values
-                        case 'player' | 'output' | 'songs_path' | 'covers_path' | 'log_level':
+                        case 'player' | 'output' | 'songs_path' | 'covers_path' | 'cache_path' | 'socket_path' | 'serve_host' | 'anilist_url' | 'log_level' | 'min_vintage' | 'max_vintage' | 'profile':
                             setattr(self, key, value)
                         # Switches
-                        case 'prefer_english' | 'offline_mode' | 'exact_search' | 'copyright_as_album' | 'update_metadata' | 'start_with_unplayed' | 'enable_discord_rpc' | 'include_cover_art':
+                        case 'prefer_english' | 'offline_mode' | 'exact_search' | 'prefix_search' | 'search_any' | 'copyright_as_album' | 'update_metadata' | 'start_with_unplayed' | 'spaced_repetition' | 'enable_discord_rpc' | 'include_cover_art' | 'race_hosts' | 'persistent_player' | 'watch_lists' | 'analyse_audio' | 'normalise_volume' | 'explain_filters' | 'show_stats':
                             setattr(self, key, bool(int(value)))
+                        # Integers
+                        case 'prefetch_count' | 'workers' | 'songs_quota' | 'cover_cache_size' | 'covers_quota' | 'cover_max_size' | 'host_connections' | 'sync_retries' | 'serve_port':
+                            setattr(self, key, int(value))
                         # Floats
                         case 'min_difficulty' | 'max_difficulty':
                             setattr(self, key, float(value))
                         # Lists
-                        case 'lists' | 'search_artists' | 'search_anime':
+                        case 'lists' | 'song_types' | 'anime_types' | 'search_artists' | 'search_anime' | 'search_titles' | 'search_composers' | 'search_arrangers':
                             setattr(self, key, shlex.split(value))
                         # Ignore anything else
                         case _:
@@ -62,30 +97,62 @@ class Options:
                 except (ValueError, AttributeError):
                     print(f"Ignoring invalid value for option {key}: '{value}'")
 
-    def from_options(self):
+    def from_options(self, args=None):
         '''
-        Sets options from command line arguments. This will overwrite options loaded from file.
+        Sets options from command line arguments, or `args` if given. This will overwrite options loaded from file.
         '''
         parser = argparse.ArgumentParser()
+        parser.add_argument("command", default=self.command, nargs='?', choices=["play", "sync", "daemon"], help="play the playlist, download every song in it without playing anything, or play in the background controlled by client.py")
         parser.add_argument("-l", "--lists", default=self.lists, type=Path, nargs='+', help="lists to play, can be either directories or files")
         parser.add_argument("-p", "--player", default=self.player, type=str, help="the audio player to use")
         parser.add_argument("-o", "--output", default=self.output, type=Path, help="output file of the currently playing song")
         parser.add_argument("--songs-path", default=self.songs_path, type=Path, help="directory to save song data to")
         parser.add_argument("--covers-path", default=self.covers_path, type=Path, help="directory to save anime cover data to")
+        parser.add_argument("--cache-path", default=self.cache_path, type=Path, help="directory to save cached data to")
+        parser.add_argument("--socket-path", default=self.socket_path, type=Path, help="socket the daemon listens for client.py on")
+        parser.add_argument("--serve-host", default=self.serve_host, type=str, metavar="ADDRESS", help="address to serve the playlist on, 0.0.0.0 to allow other machines")
+        parser.add_argument("--serve-port", default=self.serve_port, type=int, metavar="PORT", help="serve the playlist and its songs over HTTP on this port, 0 to not serve")
         parser.add_argument("--prefer-english", default=self.prefer_english, action="store_true", help="show titles in english")
         parser.add_argument("--offline-mode", default=self.offline_mode, action="store_true", help="use the program without features requiring an internet connection")
         parser.add_argument("--log-level", default=self.log_level, type=str, help="level of logs to show")
         parser.add_argument("--min-difficulty", default=self.min_difficulty, type=float, metavar="MIN", help="minimum song difficulty to play")
         parser.add_argument("--max-difficulty", default=self.max_difficulty, type=float, metavar="MAX", help="maximum song difficulty to play")
+        parser.add_argument("--song-types", default=self.song_types, type=str, nargs='*', metavar="TYPE", help="types of songs to play, like opening, ending or insert")
+        parser.add_argument("--anime-types", default=self.anime_types, type=str, nargs='*', metavar="TYPE", help="types of anime to play from, like tv, movie or ova")
+        parser.add_argument("--min-vintage", default=self.min_vintage, type=str, metavar="VINTAGE", help="earliest anime to play from, like \"spring 2010\" or 2010")
+        parser.add_argument("--max-vintage", default=self.max_vintage, type=str, metavar="VINTAGE", help="latest anime to play from, like \"fall 2015\" or 2015")
         parser.add_argument("--search-artists", default=self.search_artists, type=str, nargs='*', metavar="ARTIST", help="search for artists to play from")
         parser.add_argument("--search-anime", default=self.search_anime, type=str, nargs='*', metavar="ANIME", help="search for anime to play from")
+        parser.add_argument("--search-titles", default=self.search_titles, type=str, nargs='*', metavar="TITLE", help="search for song titles to play from")
+        parser.add_argument("--search-composers", default=self.search_composers, type=str, nargs='*', metavar="COMPOSER", help="search for composers to play from")
+        parser.add_argument("--search-arrangers", default=self.search_arrangers, type=str, nargs='*', metavar="ARRANGER", help="search for arrangers to play from")
         parser.add_argument("--exact-search", default=self.exact_search, action="store_true", help="show results for exact searches only")
+        parser.add_argument("--prefix-search", default=self.prefix_search, action="store_true", help="show results for words starting with the search only")
+        parser.add_argument("--search-any", default=self.search_any, action="store_true", help="show results matching any search instead of all of them")
         parser.add_argument("--copyright-as-album", default=self.copyright_as_album, action="store_true", help="sets mp3 copyright info as album info instead")
         parser.add_argument("--update-metadata", default=self.update_metadata, action="store_true", help="updates mp3 metadata for all previously downloaded songs")
         parser.add_argument("--start-with-unplayed", default=self.start_with_unplayed, action="store_true", help="starts playlist with unplayed songs first")
+        parser.add_argument("--spaced-repetition", default=self.spaced_repetition, action="store_true", help="orders songs so the ones due for practice are played first")
         parser.add_argument("--enable-discord-rpc", default=self.enable_discord_rpc, action="store_true", help="enables discord rich presence")
         parser.add_argument("--include-cover-art", default=self.include_cover_art, action="store_true", help="adds anime covert art to audio tracks")
-        args = parser.parse_args()
+        parser.add_argument("--prefetch-count", default=self.prefetch_count, type=int, metavar="COUNT", help="number of upcoming songs to download in the background")
+        parser.add_argument("--workers", default=self.workers, type=int, metavar="COUNT", help="number of songs to work on at once when updating metadata")
+        parser.add_argument("--songs-quota", default=self.songs_quota, type=int, metavar="MB", help="maximum size of the songs directory, deleting the least played songs to fit, 0 for no limit")
+        parser.add_argument("--cover-cache-size", default=self.cover_cache_size, type=int, metavar="MB", help="memory to use for keeping covers loaded while updating metadata")
+        parser.add_argument("--covers-quota", default=self.covers_quota, type=int, metavar="MB", help="maximum size of the covers directory, 0 for no limit")
+        parser.add_argument("--cover-max-size", default=self.cover_max_size, type=int, metavar="PIXELS", help="shrink covers larger than this before adding them to tracks, 0 to keep them as they are")
+        parser.add_argument("--anilist-url", default=self.anilist_url, type=str, metavar="URL", help="Anilist API to look up cover art from")
+        parser.add_argument("--race-hosts", default=self.race_hosts, action="store_true", help="ask the two best hosts for each song at once and use the quickest")
+        parser.add_argument("--persistent-player", default=self.persistent_player, action="store_true", help="keep one mpv running and control it over IPC, for gapless playback")
+        parser.add_argument("--watch-lists", default=self.watch_lists, action="store_true", help="reload lists when their files change, without restarting the playlist")
+        parser.add_argument("--analyse-audio", default=self.analyse_audio, action="store_true", help="read the real duration of downloaded songs, and measure how loud they are")
+        parser.add_argument("--normalise-volume", default=self.normalise_volume, action="store_true", help="play every song at a similar volume, measuring songs with ffmpeg if they haven't been already")
+        parser.add_argument("--host-connections", default=self.host_connections, type=int, metavar="COUNT", help="maximum number of songs to download from each host at once, 0 for no limit")
+        parser.add_argument("--sync-retries", default=self.sync_retries, type=int, metavar="COUNT", help="number of times to try downloading a song again when syncing")
+        parser.add_argument("--explain-filters", default=self.explain_filters, action="store_true", help="show the order filters run in, and how many songs each one left")
+        parser.add_argument("--show-stats", default=self.show_stats, action="store_true", help="time each stage of the player and show a summary when it exits")
+        parser.add_argument("--profile", default=self.profile, type=Path, metavar="FILE", help="profile the player with cProfile, writing pstats data to this file")
+        args = parser.parse_args(args)
 
         # Set values
         for key, value in vars(args).items():
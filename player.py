@@ -1,8 +1,21 @@
 
-import argparse, logging, os, pathlib, traceback
+import time
+
+# Taken before anything else is imported, so startup timings include imports
+START = time.perf_counter()
+
+import argparse, cProfile, logging, multiprocessing, os, pathlib, pstats, traceback
+from daemon import Daemon
 from database import Database
+from hosts import hosts
+from index import get_index
 from options import Options
 from playlist import Playlist
+from server import StreamServer
+from stats import stats
+from sync import Syncer
+
+IMPORTED = time.perf_counter()
 
 def main():
     print("unnamed music player version: 20241124")
@@ -17,25 +30,89 @@ def main():
     log_level = getattr(logging, options.log_level, 30)
     logging.basicConfig(level=log_level, format="[%(levelname)s] %(message)s")
 
+    # Time each stage, and profile everything the main thread does if asked to
+    stats.enabled = options.show_stats or bool(options.profile)
+    stats.started = START
+    stats.record("startup_imports", IMPORTED - START)
+    profiler = None
+
+    if options.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     # Ensure we have correct directories
     os.makedirs(options.songs_path, exist_ok=True)
     os.makedirs(options.covers_path, exist_ok=True)
+    os.makedirs(options.cache_path, exist_ok=True)
+
+    # Index downloaded songs so we don't have to search for them every time
+    with stats.timer("startup_index"):
+        index = get_index(options.songs_path, os.path.join(options.cache_path, "index.json"))
+
+    # Remember which hosts have been working well between runs
+    hosts.load_stats(os.path.join(options.cache_path, "hosts.json"))
+    hosts.limit(options.host_connections)
+
+    # Syncing is for getting ready to play offline, so it needs the songs we don't have yet
+    if options.command == "sync":
+        options.offline_mode = False
+
+    # The daemon can only control songs while they play through a persistent player
+    if options.command == "daemon":
+        options.persistent_player = True
 
     # Set up database
-    db = Database("player.db")
-    db.initalise()
+    with stats.timer("startup_database"):
+        db = Database("player.db")
+        db.initalise()
 
     # Start playlist
     playlist = Playlist(options, db)
-    playlist.create()
+
+    with stats.timer("create_playlist"):
+        playlist.create()
 
     if options.update_metadata:
         print("Updating metadata of previously downloaded songs...")
         playlist.update_metadata()
 
-    playlist.play()
+    # Let other machines listen along while we play
+    if options.serve_port and options.command != "sync":
+        StreamServer(options, playlist).start()
+
+    try:
+        if options.command == "sync":
+            Syncer(options, playlist.songs).sync()
+
+            # Measure songs while we're at it, so playing offline doesn't have to. This replaces the background pass
+            # started with the playlist, which only knew about songs downloaded before syncing.
+            if playlist.analyse_audio():
+                playlist.analyser.close()
+                playlist.analyser.analyse(playlist.songs)
+        elif options.command == "daemon":
+            Daemon(options, playlist).run()
+        else:
+            playlist.play()
+    finally:
+        # Analysis in the background saves what it has before the database closes
+        playlist.analyser.close()
+        index.save()
+        hosts.save_stats()
+        db.close()
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+            print(f"Profile written to {options.profile}, the slowest calls were:")
+            pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(15)
+
+        if stats.enabled:
+            stats.report()
 
 if __name__ == "__main__":
+    # Needed for worker processes to start when bundled into an executable
+    multiprocessing.freeze_support()
+
     try:
         main()
     except:
@@ -1,9 +1,28 @@
 
-import json, logging, random, os, time
+import logging, queue, random, os, threading, time
+import numpy as np
+from analysis import Analyser
+from cache import SongCache
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from dispatcher import Dispatcher
+from filters import FilterPlan, Stage, filter_stages, INDEXED_SEARCH_COST, SEARCH_COST
 from getch import getch_or_timeout
-from pypresence import Presence, ActivityType
-from songs import Song
+from lists import ListCache, decode_file
+from mpv import MpvPlayer
+from prefetch import Prefetcher
+from scheduler import schedule
+from search import SearchIndex, scan
+from stats import stats
+from table import SongTable
+from tagging import Tagger
+from watcher import ListWatcher
+
+# Discord allows 5 rich presence updates every 20 seconds
+RICH_PRESENCE_INTERVAL = 4
+
+# How long to wait for a second press of the player's quit key, to go back a song instead
+BACK_WINDOW = 0.3
 
 class Playlist:
     def __init__(self, options, database):
@@ -17,114 +36,372 @@ class Playlist:
         self.count = 0
         self.duration = 0
 
-        # Discord rich presence
+        # Persistent player, if we're using one
+        self.player = None
+
+        # Downloaded songs, kept under the size limit
+        self.cache = SongCache(options, database)
+
+        # Real durations and volume adjustments of downloaded songs
+        self.analyser = Analyser(options, database)
+
+        # Songs loaded from each list file, so we know what changed when a file is loaded again
+        self.sources = {}
+        self.watcher = None
+
+        # Runs updates for each song in the background while it plays
+        self.dispatcher = None
+
+        # Commands from outside the terminal, sent as the keys they stand for, whether to read keys from the terminal too,
+        # and a playlist to switch to
+        self.controls = queue.Queue()
+        self.use_terminal = True
+        self.replacement = None
+        self.lock = threading.Lock()
+        self.index = 0
+
+        # Loaded songs and their search index, kept around when playlists are rebuilt from the same songs
+        self.library_cache = None
+        self.keep_search_index = False
+        self.search_index = None
+
+        # Discord rich presence, connected in the background so it doesn't hold up loading lists
+        self.rpc = None
+        self.rpc_thread = None
+
         if self.options.enable_discord_rpc:
-            self.rpc = Presence(1299967728874029137)
-            self.rpc.connect()
+            self.rpc_thread = threading.Thread(target=self.connect_rich_presence, name="discord", daemon=True)
+            self.rpc_thread.start()
 
-    def load_file(self, file, songs):
+    def connect_rich_presence(self):
         '''
-        Loads a anisongdb json file.
+        Connects to discord for rich presence.
         '''
-        try:
-            with open(file, 'r', encoding="utf-8") as f:
-                anisong_json = json.load(f)
+        from pypresence import Presence
 
+        try:
+            with stats.timer("discord_connect"):
+                rpc = Presence(1299967728874029137)
+                rpc.connect()
         except Exception as e:
-            logging.warning(f"Failed to decode {file}: {e}")
+            logging.warning(f"Failed to connect to discord, rich presence will not be shown: {e}")
             return
 
-        # Decode entry in json
-        for entry in anisong_json:
-            song = Song.decode(entry)
+        self.rpc = rpc
+
+    @stats.timed("load_files")
+    def load_files(self, files, songs):
+        '''
+        Loads anisongdb json files. Files that changed since they were cached are parsed in parallel.
+        '''
+        cache = ListCache(os.path.join(self.options.cache_path, "lists"))
+        decoded = {file: cache.get(file) for file in files}
+        uncached = [file for file, file_songs in decoded.items() if file_songs is None]
+
+        logging.debug(f"Loading {len(files)} files, {len(uncached)} not cached")
+
+        # Starting worker processes takes a while, so only do it if there's more than one file to parse
+        if len(uncached) > 1:
+            with ProcessPoolExecutor() as executor:
+                results = list(executor.map(decode_file, uncached))
+        else:
+            results = [decode_file(file) for file in uncached]
+
+        for file, (file_songs, error) in zip(uncached, results):
+            if error:
+                logging.warning(f"Failed to decode {file}: {error}")
+                continue
+
+            cache.set(file, file_songs)
+            decoded[file] = file_songs
 
-            # Some songs have no url, ignore them since we can't download them
-            if not song.audio:
-                logging.info(f"No audio link found: {song.full_name(self.options.prefer_english)}")
+        for file in files:
+            if decoded[file] is None:
                 continue
 
-            songs.add(song)
-            self.total_songs += 1
+            self.sources[file] = set()
+
+            for song in decoded[file]:
+                # Some songs have no url, ignore them since we can't download them
+                if not song.audio:
+                    logging.info(f"No audio link found: {song.full_name(self.options.prefer_english)}")
+                    continue
+
+                songs.add(song)
+                self.sources[file].add(song)
+                self.cache.keys.add(song.key)
+                self.total_songs += 1
 
-        self.total_files += 1
+            self.total_files += 1
 
-    def load_dir(self, dir, songs):
+    def find_files(self):
         '''
-        Loads a directory of anisongdb json files.
+        Finds anisongdb json files in the lists we want to play.
         '''
-        for file in os.listdir(dir):
-            path = os.path.join(dir, file)
+        files = []
 
-            # Load only files from directories, this will not recursively load subdirectories.
+        for path in self.options.lists:
             if os.path.isfile(path):
-                self.load_file(path, songs)
+                files.append(os.path.normpath(path))
+            elif os.path.isdir(path):
+                # Load only files from directories, this will not recursively load subdirectories.
+                for file in os.listdir(path):
+                    if os.path.isfile(os.path.join(path, file)):
+                        files.append(os.path.normpath(os.path.join(path, file)))
+            else:
+                logging.warning(f"Not a file or directory: {path}")
+
+        return files
 
     def create(self):
         '''
         Creates a playlist by loading files and filtering songs.
         '''
         songs = set()
+        self.load_files(self.find_files(), songs)
 
-        for path in self.options.lists:
-            if os.path.isfile(path):
-                self.load_file(path, songs)
-            elif os.path.isdir(path):
-                self.load_dir(path, songs)
-            else:
-                logging.warning(f"Not a file or directory: {path}")
+        self.songs, self.duration = self.build(list(songs))
+        self.count = len(self.songs)
+
+        minutes, seconds = divmod(int(self.duration), 60)
+        hours, minutes = divmod(minutes, 60)
+        print(f"Loaded {self.count}/{self.total_songs} songs from {self.total_files} files, with a total playlist duration of {hours}:{minutes:0<2}:{seconds:0<2}")
+        self.cache.report(self.songs)
+
+    def build(self, songs):
+        '''
+        Filters and orders songs to play, returning them along with their total duration.
+        '''
+        table, mask = self.filter(songs)
+        selected = table.select(mask)
+        duration = float(table.duration[mask].sum())
 
-        # Filter song list
-        if self.options.offline_mode:
-            songs = filter(lambda song: os.path.isfile(song.file_path(self.options.songs_path)), songs)
+        # Songs that haven't been analysed yet are done in the background, so they don't hold up the first song
+        if self.analyse_audio():
+            self.analyser.analyse(selected, background=True)
+            duration = sum(song.duration for song in selected)
 
-        if self.options.min_difficulty:
-            songs = filter(lambda song: self.options.min_difficulty <= song.difficulty if song.difficulty else False, songs)
+        if self.options.spaced_repetition:
+            selected = schedule(selected, self.database.select_many(selected), table.difficulty[mask])
+        else:
+            random.shuffle(selected)
 
-        if self.options.max_difficulty:
-            songs = filter(lambda song: song.difficulty <= self.options.max_difficulty if song.difficulty else False, songs)
+        if self.options.start_with_unplayed:
+            selected.sort(key=lambda song: song.is_downloaded(self.options.songs_path))
 
-        if self.options.search_artists:
-            if self.options.exact_search:
-                songs = filter(lambda song: song.artist.lower() in self.options.search_artists, songs)
-            else:
-                songs = filter(lambda song: any(artist in song.artist.lower() for artist in self.options.search_artists), songs)
+        return selected, duration
 
-        if self.options.search_anime:
-            if self.options.exact_search:
-                songs = filter(lambda song: song.anime.name.lower() in self.options.search_anime or song.anime.name_jp.lower() in self.options.search_anime, songs)
-            else:
-                songs = filter(lambda song: any(anime in song.anime.name.lower() or anime in song.anime.name_jp.lower() for anime in self.options.search_anime), songs)
+    def library(self):
+        '''
+        Gets every song in the lists we want to play, only loading files we haven't loaded yet. The same list is
+        returned until the files change, so its search index can be reused.
+        '''
+        files = self.find_files()
+        self.load_files([file for file in files if file not in self.sources], set())
+
+        key = tuple(files), tuple(len(self.sources.get(file, ())) for file in files)
+
+        if self.library_cache is None or self.library_cache[0] != key:
+            self.library_cache = key, list(set().union(*(self.sources.get(file, set()) for file in files)))
+
+        return self.library_cache[1]
+
+    def replace(self, songs, duration):
+        '''
+        Switches to a different playlist, starting from its first song. The current song is skipped if one is playing.
+        '''
+        with self.lock:
+            self.replacement = songs, duration
+
+        self.controls.put(b'n')
+
+    def take_replacement(self):
+        '''
+        Switches to the playlist given to `replace`, if there is one. Returns whether it did.
+        '''
+        with self.lock:
+            replacement, self.replacement = self.replacement, None
+
+        if not replacement:
+            return False
+
+        # Controls sent for the old playlist, like the skip from `replace`, shouldn't affect the new one
+        while not self.controls.empty():
+            self.controls.get_nowait()
+
+        self.songs[:], self.duration = replacement
+        self.count = len(self.songs)
+        return True
+
+    def analyse_audio(self):
+        return self.options.analyse_audio or self.options.normalise_volume
+
+    def analyse_downloaded(self, song):
+        '''
+        Analyses a song that was just downloaded, so it plays at the right volume.
+        '''
+        self.analyser.analyse([song])
+
+    def filter(self, songs, use_index=True):
+        '''
+        Filters songs using the playlist options, returning a table of the songs and a mask of the ones to play. Without
+        `use_index`, searches always scan, leaving any kept search index alone.
+        '''
+        table = SongTable(songs)
+        stages = filter_stages(self.options)
+
+        if self.searches():
+            stages.append(self.search_stage(songs, use_index))
+
+        plan = FilterPlan(stages)
+        mask = plan.run(table)
+
+        if self.options.explain_filters:
+            print(plan.explain())
+
+        return table, mask
+
+    def reload(self, start):
+        '''
+        Loads list files that changed again, adding their new songs to the rest of the playlist and dropping removed ones.
+        '''
+        changed = self.watcher.changes()
+
+        if not changed:
+            return
+
+        old_sources = {file: self.sources.pop(file, set()) for file in changed}
+        old_songs = set().union(*old_sources.values())
+
+        # Songs can be in more than one list, and they stay as long as any list still has them
+        other_songs = set().union(*self.sources.values())
+
+        new_songs = set()
+        self.load_files([file for file in changed if os.path.isfile(file)], new_songs)
+
+        # A file that failed to load, like one caught half written, keeps its songs until it changes again
+        for file, songs in old_sources.items():
+            if os.path.isfile(file) and file not in self.sources:
+                self.sources[file] = songs
+                new_songs |= songs
+
+        added = new_songs - old_songs - other_songs
+        removed = old_songs - new_songs - other_songs
 
-        self.songs = list(songs)
+        # Only a few songs are added, so scan them instead of replacing the daemon's search index of the whole library
+        table, mask = self.filter(list(added), use_index=False)
+        added = table.select(mask)
+
+        # Mix new songs in with the ones we haven't played yet
+        upcoming = [song for song in self.songs[start:] if song not in removed]
+        removed_count = len(self.songs) - start - len(upcoming)
+
+        for song in added:
+            upcoming.insert(random.randint(0, len(upcoming)), song)
+
+        self.songs[start:] = upcoming
         self.count = len(self.songs)
         self.duration = sum(song.duration for song in self.songs)
-        random.shuffle(self.songs)
 
-        if self.options.start_with_unplayed:
-            self.songs.sort(key=lambda song: os.path.exists(song.file_path(self.options.songs_path)))
+        print(f"Reloaded {len(changed)} {'list' if len(changed) == 1 else 'lists'}: added {len(added)} songs, removed {removed_count} songs")
 
-        minutes, seconds = divmod(int(self.duration), 60)
-        hours, minutes = divmod(minutes, 60)
-        print(f"Loaded {self.count}/{self.total_songs} songs from {self.total_files} files, with a total playlist duration of {hours}:{minutes:0<2}:{seconds:0<2}")
+    def searches(self):
+        '''
+        Gets the search terms of each field that's being searched.
+        '''
+        searches = {
+            'artist': self.options.search_artists,
+            'anime': self.options.search_anime,
+            'title': self.options.search_titles,
+            'composers': self.options.search_composers,
+            'arrangers': self.options.search_arrangers,
+        }
+        return {field: terms for field, terms in searches.items() if terms}
+
+    def search_stage(self, songs, use_index=True):
+        '''
+        Gets a filter stage for the search options. Without a kept search index, only songs left by earlier stages are
+        scanned, so cheap filters make searching faster.
+        '''
+        use_index = use_index and self.keep_search_index
+        indexed = use_index and self.search_index and self.search_index[0] is songs
+
+        def apply(table, mask):
+            result = np.zeros(len(table), dtype=bool)
+
+            if use_index:
+                result[sorted(self.search(table.songs))] = True
+            else:
+                positions = np.flatnonzero(mask)
+                matches = self.search([table.songs[position] for position in positions], use_index=False)
+                result[positions[sorted(matches)]] = True
+
+            return result
+
+        return Stage("search", INDEXED_SEARCH_COST if indexed else SEARCH_COST, 0.05, apply)
+
+    def search(self, songs, use_index=True):
+        '''
+        Searches songs using the search options, returning the positions of matching songs. Songs need to match every
+        field searched, or any field if `search_any` is set. The songs are searched through the kept search index if
+        there is one and `use_index` is set, otherwise they're scanned.
+        '''
+        searches = self.searches()
+
+        if self.options.exact_search:
+            mode = "exact"
+        elif self.options.prefix_search:
+            mode = "prefix"
+        else:
+            mode = "substring"
+
+        # An index only pays for itself when the same songs are searched again, like in the daemon. Otherwise, scanning
+        # the songs once is much quicker than building one
+        if use_index and self.keep_search_index:
+            if not self.search_index or self.search_index[0] is not songs:
+                self.search_index = songs, SearchIndex(songs)
+
+            search = self.search_index[1].search
+        else:
+            search = lambda field, terms, mode: scan(songs, field, terms, mode)
+
+        matches = None
+
+        for field, terms in searches.items():
+            ids = search(field, terms, mode)
+
+            if matches is None:
+                matches = ids
+            elif self.options.search_any:
+                matches |= ids
+            else:
+                matches &= ids
+
+        return matches
 
     def update_currently_playing(self, currently_playing):
         '''
         Updates output file to the current song.
         '''
-        encoded = ""
+        # Rainmeter needs characters outside of latin-1 written as character references
+        encoded = "".join(rf"[\{ord(char)}]" if ord(char) >= 256 else char for char in currently_playing)
 
-        for char in currently_playing:
-            value = ord(char)
-            encoded += rf"[\{value}]" if value >= 256 else char
+        # Write to a temporary file first, so Rainmeter never reads a half written file
+        temp_path = f"{self.options.output}.tmp"
 
-        with open(self.options.output, 'w') as f:
+        with open(temp_path, 'w') as f:
             f.write(encoded)
 
+        os.replace(temp_path, self.options.output)
+
     def update_database(self, song):
         '''
         Updates last played information in the database.
         '''
         play_count, last_played = self.database.select(song)
+
+        # Written straight away instead of in the background, so history never waits behind a slow Discord connection or
+        # gets lost if the dispatcher can't finish before the database is closed. It's one small write on an open connection.
         self.database.update(song)
 
         if play_count == 0:
@@ -134,10 +411,18 @@ class Playlist:
         delta = datetime.now() - last_played
         print(f"You have played this song {play_count} {'time' if play_count == 1 else 'times'}, most recently on {last_played.strftime('%Y/%m/%d')} ({delta.days} {'day' if delta.days == 1 else 'days'} ago)")
 
-    def update_rich_presence(self, song):
+    def update_rich_presence(self, song, start):
         '''
-        Updates discord rich presence to the current song.
+        Updates discord rich presence to the current song, which started playing at `start`.
         '''
+        from pypresence import ActivityType
+
+        # This runs in the background, so it's fine to wait here until we're connected
+        self.rpc_thread.join()
+
+        if not self.rpc:
+            return
+
         details = song.title
         state = f"{song.artist} ({song.anime_name(self.options.prefer_english)})"
 
@@ -168,8 +453,8 @@ class Playlist:
             activity_type=ActivityType.LISTENING,
             details=details,
             state=state,
-            start=time.time(),
-            end=time.time() + song.duration,
+            start=start,
+            end=start + song.duration,
             buttons=buttons or None,
         )
 
@@ -177,52 +462,138 @@ class Playlist:
         '''
         Updates all metadata for playlist.
         '''
-        downloaded_songs = list(filter(lambda song: os.path.isfile(song.file_path(self.options.songs_path)), self.songs))
-
-        for index, song in enumerate(downloaded_songs):
-            song.set_metadata(self.options)
-            print(f"Updated metadata for {song.full_name(self.options.prefer_english)} ({index+1}/{len(downloaded_songs)})")
+        downloaded_songs = list(filter(lambda song: song.is_downloaded(self.options.songs_path), self.songs))
+        Tagger(self.options).tag(downloaded_songs)
 
     def play(self):
         '''
         Plays songs from playlist.
         '''
+        # We are permitted to download songs if we aren't in offline mode
+        prefetcher = None
+
+        if not self.options.offline_mode:
+            prefetcher = Prefetcher(self.options, self.songs, on_download=self.analyse_downloaded if self.analyse_audio() else None)
+
+        if self.options.watch_lists:
+            self.watcher = ListWatcher(self.options.lists)
+            self.watcher.start()
+
+        self.dispatcher = Dispatcher({'rich_presence': RICH_PRESENCE_INTERVAL})
+
+        if self.options.persistent_player:
+            self.player = MpvPlayer(self.options.player, self.analyser.gains if self.options.normalise_volume else {}, self.controls, self.use_terminal)
+
+            try:
+                self.player.start()
+            except OSError as e:
+                logging.warning(f"Failed to start persistent player, starting a new player for each song instead: {e}")
+                self.player = None
+
+        try:
+            self.play_songs(prefetcher)
+        finally:
+            if prefetcher:
+                prefetcher.close()
+            if self.player:
+                self.player.close()
+            if self.watcher:
+                self.watcher.close()
+                self.watcher = None
+
+            self.dispatcher.close()
+
+        logging.info("Playlist has ended")
+
+    def play_songs(self, prefetcher):
+        '''
+        Plays songs from playlist, downloading upcoming songs in the background.
+        '''
         index = 0
+        first_song = True
 
         while index < self.count:
+            # Time from the previous song ending to the next one being handed to the player
+            change_start = time.perf_counter()
+
+            if self.take_replacement():
+                index = 0
+                continue
+
+            if self.watcher:
+                self.reload(index)
+
+            self.index = index
             song = self.songs[index]
 
-            # We are permitted to download the song if we aren't in offline mode
-            if not self.options.offline_mode:
-                song.download(self.options)
+            if prefetcher:
+                prefetcher.schedule(index)
+                prefetcher.wait(song)
+
+                # Make room for new songs, keeping the ones around where we are in the playlist
+                self.cache.evict(self.songs[max(0, index - 1):index + self.options.prefetch_count + 1])
 
             # If we can't find the song, skip it. This should only happen if songs were deleted from the data folder.
-            if not os.path.isfile(song.file_path(self.options.songs_path)):
-                logging.warning(f"File not found: {song.file_path(self.options.songs_path)}")
+            path = song.file_path(self.options.songs_path)
+
+            if not os.path.isfile(path):
+                logging.warning(f"File not found: {path}")
+                index += 1
                 continue
 
             currently_playing = f"{song.full_name(self.options.prefer_english)} ({index+1}/{self.count}) {{{song.difficulty}%}}"
             print(f"Currently playing: {currently_playing}")
 
+            # Only the latest of these matters if songs are being skipped quickly
             if self.options.output:
-                self.update_currently_playing(currently_playing)
+                self.dispatcher.submit(self.update_currently_playing, currently_playing, name="currently_playing")
 
             self.update_database(song)
 
             if self.options.enable_discord_rpc:
-                self.update_rich_presence(song)
+                self.dispatcher.submit(self.update_rich_presence, song, time.time(), name="rich_presence")
 
-            song.play(self.options)
+            stats.record("song_change", time.perf_counter() - change_start)
 
-            # Check user input for if we want to do some extra function
-            char = getch_or_timeout(0.3)
-            logging.debug(f"Got character: {char}")
+            if first_song:
+                first_song = False
+                stats.record("time_to_first_song", time.perf_counter() - stats.started)
+                logging.info(f"Time to first song: {time.perf_counter() - stats.started:.2f}s")
 
-            if char == b'q':
+            action = self.play_song(song, path, index)
+
+            if action == "back":
                 index = max(0, index - 1)
-            elif char == b'\x1b':
+            elif action == "quit":
                 break
             else:
                 index += 1
 
-        logging.info("Playlist has ended")
+    def play_song(self, song, path, index):
+        '''
+        Plays a song, then returns whether to go to the next song, go back a song, or quit.
+        '''
+        if self.player:
+            # Queue the next song in the player if it's ready, so it can start without a gap
+            next_path = None
+
+            if index + 1 < self.count and self.songs[index + 1].is_downloaded(self.options.songs_path):
+                next_path = self.songs[index + 1].file_path(self.options.songs_path)
+
+            return self.player.play(path, next_path)
+
+        start = time.monotonic()
+        song.play(self.options, self.analyser.gains.get(song.key) if self.options.normalise_volume else None)
+
+        # A song that ended early was closed by the user, so give them a moment to press the quit key again to go back.
+        # Songs that played to the end go straight on to the next one.
+        ended_early = time.monotonic() - start < song.duration - 1
+        char = getch_or_timeout(BACK_WINDOW if ended_early else 0) if self.use_terminal else None
+        logging.debug(f"Got character: {char}")
+
+        if char == b'q':
+            return "back"
+        elif char == b'\x1b':
+            return "quit"
+
+        return "next"
@@ -0,0 +1,80 @@
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher:
+    '''
+    Downloads and tags upcoming songs in the background while the current song plays.
+    '''
+    def __init__(self, options, songs, workers=2, on_download=None):
+        self.options = options
+        self.songs = songs
+        self.on_download = on_download
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.pending = {}
+        self.closed = False
+        self.hook_lock = threading.Lock()
+
+        # Songs that were ready when we wanted to play them, and songs we had to wait for
+        self.hits = 0
+        self.misses = 0
+
+    def schedule(self, index):
+        '''
+        Queues downloads for the song at `index` and the next few songs, in playing order.
+        '''
+        window = [song for song in self.songs[index:index + self.options.prefetch_count + 1] if not song.is_downloaded(self.options.songs_path)]
+
+        # Pull back anything that hasn't started yet, so the song at `index` always goes to the front of the queue
+        for song, future in list(self.pending.items()):
+            if future.cancel():
+                del self.pending[song]
+
+        for song in window:
+            if song not in self.pending:
+                self.pending[song] = self.executor.submit(self.download, song)
+
+    def wait(self, song):
+        '''
+        Waits until a song is downloaded, downloading it now if it wasn't queued.
+        '''
+        future = self.pending.pop(song, None)
+
+        if future and future.done() or not future and song.is_downloaded(self.options.songs_path):
+            self.hits += 1
+            logging.info(f"Prefetch hit: {song.audio}")
+        else:
+            self.misses += 1
+            logging.info(f"Prefetch miss: {song.audio}")
+
+        try:
+            if future:
+                future.result()
+            else:
+                self.download(song)
+        except Exception as e:
+            logging.warning(f"Download failed: {e}")
+
+    def download(self, song):
+        '''
+        Downloads a song, then does anything else that needs doing before it's played.
+        '''
+        if not song.download(self.options) or not self.on_download:
+            return
+
+        # Downloads still running when we close can finish, but the database may be closed by then
+        with self.hook_lock:
+            if not self.closed:
+                self.on_download(song)
+
+    def close(self):
+        '''
+        Stops downloading and reports how often songs were ready in time.
+        '''
+        # Wait for a hook that's already running, and don't start any more
+        with self.hook_lock:
+            self.closed = True
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.hits or self.misses:
+            print(f"Prefetched {self.hits}/{self.hits + self.misses} songs before they were played")
@@ -0,0 +1,54 @@
+import numpy as np
+from datetime import datetime
+
+# A song played once is due again after this many days, and the interval doubles with every play after that
+BASE_INTERVAL = 1
+MAX_BOX = 8
+
+# How overdue a song we've never played counts as
+NEW_WEIGHT = 2
+
+# Songs that aren't due yet still get a small chance, so the playlist doesn't become too predictable
+MIN_WEIGHT = 0.05
+
+def intervals(play_counts, difficulty):
+    '''
+    Gets how many days to wait before playing each song again, Leitner style.
+
+    Each play moves a song up a box, doubling its interval. Difficulty is the percentage of players that guess a song,
+    so easy songs get up to half again as long between plays and hard songs half as long.
+    '''
+    boxes = np.minimum(play_counts, MAX_BOX) - 1
+    ease = np.where(np.isnan(difficulty), 1, 0.5 + difficulty / 100)
+    return BASE_INTERVAL * 2.0 ** boxes * ease
+
+def weights(songs, history, difficulty, now=None):
+    '''
+    Gets how much each song is due to be played, where 1 means it's due right now.
+    '''
+    now = now or datetime.now()
+    play_counts = np.zeros(len(songs), dtype=np.float64)
+    elapsed = np.zeros(len(songs), dtype=np.float64)
+
+    for index, song in enumerate(songs):
+        play_count, last_played = history.get(song.key, (0, None))
+
+        if play_count:
+            play_counts[index] = play_count
+            elapsed[index] = (now - last_played).total_seconds() / 86400
+
+    played = play_counts > 0
+    due = np.full(len(songs), float(NEW_WEIGHT))
+    due[played] = elapsed[played] / intervals(play_counts[played], difficulty[played])
+    return np.maximum(due, MIN_WEIGHT)
+
+def schedule(songs, history, difficulty, rng=None):
+    '''
+    Orders songs for spaced repetition, with songs that are most due to be played more likely to come first.
+
+    This is weighted random sampling without replacement: every song draws an exponential random key scaled by its
+    weight, and songs are played in order of their keys.
+    '''
+    rng = rng or np.random.default_rng()
+    keys = rng.exponential(size=len(songs)) / weights(songs, history, difficulty)
+    return [songs[index] for index in np.argsort(keys, kind='stable')]
@@ -0,0 +1,153 @@
+import bisect, re
+from collections import defaultdict
+
+# Song fields that can be searched, and how to get their values
+FIELDS = {
+    'artist': lambda song: [song.artist],
+    'title': lambda song: [song.title],
+    'anime': lambda song: [song.anime.name, song.anime.name_jp],
+    'composers': lambda song: song.composers,
+    'arrangers': lambda song: song.arrangers,
+}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+def matches(value, term, mode):
+    '''
+    Checks if a lowercase value matches a term, the same way the index would.
+    '''
+    match mode:
+        case "exact":
+            return value == term
+        case "prefix":
+            return any(token.startswith(term) for token in TOKEN_PATTERN.findall(value))
+        case _:
+            return term in value
+
+def scan(songs, field, terms, mode="substring"):
+    '''
+    Finds songs where a field matches any of the terms without building an index, for searching a list only once.
+    '''
+    get_values = FIELDS[field]
+    terms = [term.lower() for term in terms]
+
+    # Lists repeat the same artists, anime and so on, so each distinct value only needs checking once
+    checked = {}
+    ids = set()
+
+    for id, song in enumerate(songs):
+        for value in get_values(song):
+            if value not in checked:
+                lower = value.lower()
+                checked[value] = any(matches(lower, term, mode) for term in terms)
+
+            if checked[value]:
+                ids.add(id)
+                break
+
+    return ids
+
+class FieldIndex:
+    '''
+    Postings of one song field: whole values for exact searches, words for prefix searches and trigrams for substring searches.
+
+    Words and trigrams are only worked out the first time a search needs them, from each distinct value once.
+    '''
+    def __init__(self):
+        self.song_values = []
+        self.values = defaultdict(set)
+        self.tokens = None
+        self.trigrams = None
+        self.sorted_tokens = []
+
+    def add(self, values):
+        id = len(self.song_values)
+        self.song_values.append(values)
+
+        for value in values:
+            self.values[value].add(id)
+
+    def build_tokens(self):
+        self.tokens = defaultdict(set)
+
+        for value, ids in self.values.items():
+            for token in TOKEN_PATTERN.findall(value):
+                self.tokens[token] |= ids
+
+        self.sorted_tokens = sorted(self.tokens)
+
+    def build_trigrams(self):
+        self.trigrams = defaultdict(set)
+
+        for value, ids in self.values.items():
+            for trigram in trigrams(value):
+                self.trigrams[trigram] |= ids
+
+    def exact(self, term):
+        return self.values.get(term, set())
+
+    def prefix(self, term):
+        if self.tokens is None:
+            self.build_tokens()
+
+        ids = set()
+        start = bisect.bisect_left(self.sorted_tokens, term)
+
+        for token in self.sorted_tokens[start:]:
+            if not token.startswith(term):
+                break
+            ids |= self.tokens[token]
+
+        return ids
+
+    def substring(self, term):
+        # Trigrams can't narrow down short terms, so check each distinct value instead
+        if len(term) < 3:
+            return {id for value, ids in self.values.items() if term in value for id in ids}
+
+        if self.trigrams is None:
+            self.build_trigrams()
+
+        postings = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams(term)), key=len)
+        candidates = set.intersection(*postings)
+
+        # Having every trigram doesn't mean they're in the right order, so check the candidates
+        return {id for id in candidates if any(term in value for value in self.song_values[id])}
+
+class SearchIndex:
+    '''
+    Inverted index over the searchable fields of a list of songs, for searching the same songs many times. Searches
+    return the positions of matching songs.
+
+    Each field is only indexed the first time it's searched.
+    '''
+    def __init__(self, songs):
+        self.songs = songs
+        self.fields = {}
+
+    def field(self, field):
+        if field not in self.fields:
+            index = FieldIndex()
+            get_values = FIELDS[field]
+
+            for song in self.songs:
+                index.add([value.lower() for value in get_values(song)])
+
+            self.fields[field] = index
+
+        return self.fields[field]
+
+    def search(self, field, terms, mode="substring"):
+        '''
+        Finds songs where a field matches any of the terms. Mode can be "exact", "prefix" or "substring".
+        '''
+        index = self.field(field)
+        ids = set()
+
+        for term in terms:
+            ids |= getattr(index, mode)(term.lower())
+
+        return ids
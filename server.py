@@ -0,0 +1,225 @@
+import asyncio, json, logging, os, re, threading
+from index import get_index
+from urllib.parse import quote, unquote, urlsplit
+
+# Number of upcoming songs listed in the queue
+QUEUE_LENGTH = 20
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+REASONS = {200: "OK", 206: "Partial Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 416: "Range Not Satisfiable"}
+
+def parse_range(header, size):
+    '''
+    Gets the start and end (exclusive) of a single byte range, None if there's no usable range, or False if the range
+    can't be satisfied.
+    '''
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+
+    # Multiple ranges and anything else we don't understand get the whole file, which is allowed
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+
+    if not start:
+        # The last `end` bytes of the file
+        start, end = max(0, size - int(end)), size
+    else:
+        start, end = int(start), min(size, int(end) + 1) if end else size
+
+    if start >= size or start >= end:
+        return False
+
+    return start, end
+
+class StreamServer:
+    '''
+    Serves the playlist to other machines over HTTP.
+
+    The current song and upcoming queue are available as JSON and as an M3U playlist, and song files are served with
+    Range support so players can seek. Everything runs on one asyncio event loop in a background thread, files are sent
+    with sendfile where the system supports it, and songs that aren't downloaded yet are downloaded first.
+    '''
+    def __init__(self, options, playlist):
+        self.options = options
+        self.playlist = playlist
+        self.loop = None
+
+        # Downloads in progress for listeners, so several listeners asking for the same song share one download
+        self.downloads = {}
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.run, args=(ready,), name="server", daemon=True).start()
+        ready.wait()
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+
+        try:
+            self.loop.run_until_complete(asyncio.start_server(self.handle, self.options.serve_host, self.options.serve_port))
+        except OSError as e:
+            logging.warning(f"Failed to start server on {self.options.serve_host}:{self.options.serve_port}: {e}")
+            ready.set()
+            return
+
+        print(f"Serving playlist on http://{self.options.serve_host}:{self.options.serve_port}/")
+        ready.set()
+        self.loop.run_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+
+            while line := (await reader.readline()).decode("latin-1").strip():
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) != 3:
+                await self.send(writer, 400, "text/plain", b"Bad request\n")
+                return
+
+            method, target, _ = request_line
+
+            if method not in ("GET", "HEAD"):
+                await self.send(writer, 405, "text/plain", b"Method not allowed\n")
+                return
+
+            await self.route(writer, method, unquote(urlsplit(target).path), headers)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        except Exception as e:
+            logging.warning(f"Failed to handle request: {e}")
+
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, headers):
+        head = method == "HEAD"
+
+        match path.strip("/").split("/"):
+            case ["now-playing"]:
+                await self.send_json(writer, self.now_playing(headers), head)
+            case ["queue"]:
+                await self.send_json(writer, self.queue(headers), head)
+            case ["playlist.m3u"]:
+                await self.send(writer, 200, "audio/x-mpegurl", self.m3u(headers).encode(), head=head)
+            case ["songs", key] if key and key == os.path.basename(key) and not key.startswith("."):
+                await self.send_song(writer, key, headers.get("range"), head)
+            case _:
+                await self.send(writer, 404, "text/plain", b"Not found\n", head=head)
+
+    def song_info(self, song, index, headers):
+        return {
+            'index': index + 1,
+            'artist': song.artist,
+            'title': song.title,
+            'anime': song.anime_name(self.options.prefer_english),
+            'type': song.type,
+            'season': song.season,
+            'difficulty': song.difficulty,
+            'duration': song.duration,
+            'url': f"http://{headers.get('host', 'localhost')}/songs/{quote(song.key)}",
+        }
+
+    def now_playing(self, headers):
+        songs, index = self.playlist.songs, self.playlist.index
+
+        if index >= len(songs):
+            return {'song': None, 'count': len(songs)}
+
+        return {'song': self.song_info(songs[index], index, headers), 'count': len(songs)}
+
+    def queue(self, headers):
+        songs, index = self.playlist.songs, self.playlist.index
+        return [self.song_info(song, number, headers) for number, song in enumerate(songs[index:index + QUEUE_LENGTH], index)]
+
+    def m3u(self, headers):
+        lines = ["#EXTM3U"]
+
+        for song in self.queue(headers):
+            lines.append(f"#EXTINF:{int(song['duration'] or -1)},{song['artist']} - {song['title']}")
+            lines.append(song['url'])
+
+        return "\n".join(lines) + "\n"
+
+    async def send(self, writer, status, content_type, body, extra_headers=None, head=False):
+        await self.send_headers(writer, status, content_type, len(body), extra_headers)
+
+        if not head:
+            writer.write(body)
+            await writer.drain()
+
+    async def send_json(self, writer, data, head=False):
+        await self.send(writer, 200, "application/json", json.dumps(data).encode(), head=head)
+
+    async def send_headers(self, writer, status, content_type, length, extra_headers=None):
+        lines = [
+            f"HTTP/1.1 {status} {REASONS[status]}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {length}",
+            "Connection: close",
+        ]
+        lines += [f"{name}: {value}" for name, value in (extra_headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def send_song(self, writer, key, range_header, head):
+        path = await self.song_path(key)
+
+        if not path:
+            await self.send(writer, 404, "text/plain", b"Song not found\n", head=head)
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = parse_range(range_header, size)
+
+            if byte_range is False:
+                await self.send(writer, 416, "text/plain", b"Range not satisfiable\n", {'Content-Range': f"bytes */{size}"}, head)
+                return
+
+            if byte_range:
+                start, end = byte_range
+                await self.send_headers(writer, 206, "audio/mpeg", end - start, {'Accept-Ranges': "bytes", 'Content-Range': f"bytes {start}-{end - 1}/{size}"})
+            else:
+                start, end = 0, size
+                await self.send_headers(writer, 200, "audio/mpeg", size, {'Accept-Ranges': "bytes"})
+
+            if not head and end > start:
+                # Uses sendfile where the transport supports it, and reads the file in chunks otherwise
+                await self.loop.sendfile(writer.transport, f, start, end - start)
+
+    async def song_path(self, key):
+        '''
+        Finds a song's file, downloading it first if it's in the playlist but hasn't been downloaded yet.
+        '''
+        index = get_index(self.options.songs_path)
+
+        if key not in index:
+            song = next((song for song in self.playlist.songs if song.key == key), None)
+
+            if not song or self.options.offline_mode:
+                return None
+
+            if key not in self.downloads:
+                logging.info(f"Downloading song for a listener: {key}")
+                self.downloads[key] = self.loop.run_in_executor(None, song.download, self.options)
+
+            download = self.downloads[key]
+
+            # A listener hanging up shouldn't cancel the download for everyone else
+            try:
+                downloaded = await asyncio.shield(download)
+            finally:
+                if download.done():
+                    self.downloads.pop(key, None)
+
+            if not downloaded:
+                return None
+
+        return index.path(key)
@@ -1,21 +1,71 @@
 
-import filetype, json, logging, os, requests, subprocess, time
+import contextlib, logging, os, subprocess, sys, threading, time
+from covers import get_cover_service
 from dataclasses import dataclass
-from hosts import hosts
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC
-from mutagen.mp3 import MP3
-from pathlib import Path
-from typing import Dict, Set
-
-@dataclass
+from hosts import get_session, hosts
+from index import get_index
+from stats import stats
+from typing import Dict, Tuple
+
+# Size of chunks to write to disk while downloading songs
+CHUNK_SIZE = 64 * 1024
+
+# ID3 frames of the tags we set, the same ones mutagen's EasyID3 uses. mutagen is only imported when tagging.
+FRAMES = {
+    'artist': "TPE1",
+    'title': "TIT2",
+    'media': "TMED",
+    'version': "TIT3",
+    'compilation': "TCMP",
+    'tracknumber': "TRCK",
+    'date': "TDRC",
+    'composer': "TCOM",
+    'arranger': "TPE4",
+    'album': "TALB",
+    'copyright': "TCOP",
+}
+
+# Songs being downloaded, with how many threads want each one. The prefetcher, syncing and the server can all ask for
+# the same song, and only one of them may write its partial file at a time.
+downloads = {}
+downloads_lock = threading.Lock()
+
+@contextlib.contextmanager
+def download_lock(key):
+    '''
+    Holds the download lock of a song, waiting for any other thread downloading it to finish first.
+    '''
+    with downloads_lock:
+        lock, users = downloads.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        downloads[key] = lock, users + 1
+
+    try:
+        with lock:
+            yield
+    finally:
+        with downloads_lock:
+            lock, users = downloads[key]
+
+            if users == 1:
+                del downloads[key]
+            else:
+                downloads[key] = lock, users - 1
+
+def intern(value):
+    return sys.intern(value) if value else value
+
+# Anime we've decoded already, so songs from the same anime share one object
+animes = {}
+
+@dataclass(slots=True)
 class Anime:
     name: str
     name_jp: str
     season: str
     type: str
 
-@dataclass
+@dataclass(slots=True)
 class Song:
     anime: Anime
     title: str
@@ -27,43 +77,50 @@ class Song:
     id: int
     season: str
     linked_ids: Dict[str, int]
-    composers: Set[str]
-    arrangers: Set[str]
+    composers: Tuple[str, ...]
+    arrangers: Tuple[str, ...]
+
+    # Songs are identified by their audio file name, which is the same in every list and never changes
+    @property
+    def key(self):
+        return self.audio
 
     def __hash__(self):
-        if self.audio:
-            base = self.audio[-10:-4].encode()
-            return int.from_bytes(base)
-        return 0
+        return hash(self.audio)
+
+    def __eq__(self, other):
+        return isinstance(other, Song) and self.audio == other.audio
 
     @classmethod
     def decode(cls, data):
+        # Lists have hundreds of thousands of songs, but far fewer distinct anime, artists and so on, so share them
+        anime_key = (data['animeENName'], data['animeJPName'], data['animeVintage'], data['animeType'])
+
+        if anime_key not in animes:
+            animes[anime_key] = Anime(*(intern(value) for value in anime_key))
+
         return cls(
-            Anime(
-                data['animeENName'],
-                data['animeJPName'],
-                data['animeVintage'],
-                data['animeType'],
-            ),
+            animes[anime_key],
             data['songName'],
-            data['songArtist'],
-            data['songType'],
+            intern(data['songArtist']),
+            intern(data['songType']),
             data['songDifficulty'],
             data['audio'][-10:] if data['audio'] else None, # Only get file name
             data['songLength'] or 90,
             data['annSongId'],
-            data['animeVintage'],
+            intern(data['animeVintage']),
             data['linked_ids'],
-            {name for composer in data['composers'] for name in composer['names']},
-            {name for arranger in data['arrangers'] for name in arranger['names']},
+            tuple(dict.fromkeys(intern(name) for composer in data['composers'] for name in composer['names'])),
+            tuple(dict.fromkeys(intern(name) for arranger in data['arrangers'] for name in arranger['names'])),
         )
 
+    @stats.timed("file_path")
     def file_path(self, songs_path):
-        # Try to find matching file mp3 file name in a sub folder
-        for path in Path(songs_path).rglob(self.audio):
-            return path
-        # Otherwise use default path
-        return os.path.join(songs_path, self.audio)
+        # Look up the file in the index of the songs folder, otherwise use default path
+        return get_index(songs_path).path(self.audio)
+
+    def is_downloaded(self, songs_path):
+        return self.audio in get_index(songs_path)
 
     def image_file_path(self, covers_path):
         if 'anilist' not in self.linked_ids:
@@ -95,91 +152,148 @@ class Song:
 
     def download(self, options):
         '''
-        Downloads the song into our collection.
+        Downloads the song into our collection, returning whether we have it now.
         '''
-        # Don't download the file if we already have it
-        if os.path.isfile(self.file_path(options.songs_path)):
-            return
-
-        success = False
-
-        # Sometimes, hosts can be out of date. Therefore, try different ones until we get a hit.
-        for host in hosts:
-            url = host + self.audio
+        with download_lock(self.key):
+            return self.download_locked(options)
 
-            try:
-                r = requests.get(url)
-            except Exception as e:
-                logging.warning(f"Download failed: {e}")
-                continue
+    def download_locked(self, options):
+        path = self.file_path(options.songs_path)
 
-            if not r.ok:
-                continue
+        # Don't download the file if we already have it, which includes another thread having just downloaded it
+        if os.path.isfile(path):
+            return True
 
-            success = True
-            break
-
-        if not success:
+        # Sometimes, hosts can be out of date. Therefore, try different ones until we get a hit, starting with the best one.
+        for host in hosts.race(self.audio) if options.race_hosts else hosts:
+            if self.download_from(host, path):
+                break
+        else:
             logging.warning(f"Failed to get audio for {self.audio}")
-            return
+            return False
 
-        # Save file
-        with open(self.file_path(options.songs_path), 'wb') as f:
-            logging.debug(f"Saving file: {self.file_path(options.songs_path)}")
-            f.write(r.content)
+        get_index(options.songs_path).add(path)
 
         # Set the metadata
         self.set_metadata(options)
+        return True
+
+    def download_from(self, host, path):
+        '''
+        Streams the song from a host into a partial file, resuming where a previous attempt left off.
+        '''
+        import requests
+
+        part_path = f"{path}.part"
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        start = time.perf_counter()
+        size = 0
+
+        try:
+            with hosts.slot(host), get_session(host).get(host + self.audio, headers=headers, stream=True, timeout=30) as r:
+                hosts.record_response(host, r)
+
+                # The partial file doesn't match what the host has, so throw it away
+                if r.status_code == 416:
+                    os.remove(part_path)
+                    return False
+
+                if not r.ok:
+                    return False
+
+                # Only append if the host actually resumed from where we asked it to
+                resumed = r.status_code == 206 and r.headers.get('Content-Range', '').startswith(f"bytes {offset}-")
+
+                with open(part_path, 'ab' if resumed else 'wb') as f:
+                    logging.debug(f"Saving file: {path} ({'resuming from ' + str(offset) if resumed else 'new'})")
+
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+
+        except requests.RequestException as e:
+            hosts.record_failure(host)
+            logging.warning(f"Download failed: {e}")
+            return False
+
+        except OSError as e:
+            logging.warning(f"Download failed: {e}")
+            return False
+
+        os.replace(part_path, path)
+        stats.record_download(host, size, time.perf_counter() - start)
+        return True
+
+    def metadata(self, options):
+        '''
+        Gets the tags we want the song file to have.
+        '''
+        tags = {
+            'artist': self.artist,
+            'title': self.title,
+            'website': self.audio,
+            'media': f"{self.anime.type} Anime",
+            'version': self.type,
+            'compilation': "1",
+            'tracknumber': str(self.id),
+            'date': self.season[-4:],
+            'composer': '/'.join(self.composers),
+            'arranger': '/'.join(self.arrangers),
+        }
+
+        if options.copyright_as_album:
+            tags['album'] = self.anime_name(options.prefer_english)
+        else:
+            tags['copyright'] = self.anime_name(options.prefer_english)
 
+        return tags
+
+    @stats.timed("set_metadata")
     def set_metadata(self, options):
         '''
         Sets the metadata of the song to something more reasonable.
         '''
+        from mutagen import id3
+        from mutagen.id3 import ID3, ID3NoHeaderError, TENC, WOAR
+
+        path = self.file_path(options.songs_path)
+
         # We can't update tags if the song isn't downloaded
-        if not os.path.isfile(self.file_path(options.songs_path)):
+        if not os.path.isfile(path):
             return
 
-        song = MP3(self.file_path(options.songs_path), ID3=EasyID3)
-
-        if not song.tags:
-            song.tags = EasyID3()
+        try:
+            old_tags = ID3(path)
+        except ID3NoHeaderError:
+            old_tags = ID3()
 
         # Get encoding information (or title, which sometimes also has encoding information)
         encoding = ""
-        if 'encodedby' in song.tags:
-            encoding = song.tags['encodedby'][0]
-        elif 'title' in song.tags:
-            encoding = song.tags['title'][0]
-
-        # Delete existing tags
-        song.delete()
-
-        # Add tag information
-        song.tags['artist'] = self.artist
-        song.tags['title'] = self.title
-        song.tags['website'] = self.audio
-        song.tags['media'] = f"{self.anime.type} Anime"
-        song.tags['version'] = self.type
-        song.tags['compilation'] = "1"
-        song.tags['tracknumber'] = str(self.id)
-        song.tags['date'] = self.season[-4:]
-        song.tags['composer'] = '/'.join(self.composers)
-        song.tags['arranger'] = '/'.join(self.arrangers)
+        if 'TENC' in old_tags:
+            encoding = old_tags['TENC'].text[0]
+        elif 'TIT2' in old_tags:
+            encoding = old_tags['TIT2'].text[0]
 
-        if encoding:
-            song.tags['encodedby'] = encoding
+        # Start from empty tags, so anything else that was set is deleted
+        tags = ID3()
 
-        if options.copyright_as_album:
-            song.tags['album'] = self.anime_name(options.prefer_english)
-        else:
-            song.tags['copyright'] = self.anime_name(options.prefer_english)
+        for key, value in self.metadata(options).items():
+            if key == 'website':
+                tags.add(WOAR(url=value))
+            else:
+                tags.add(getattr(id3, FRAMES[key])(encoding=3, text=value))
 
-        song.save()
+        if encoding:
+            tags.add(TENC(encoding=3, text=encoding))
 
         if options.include_cover_art:
-            self.set_image(options)
+            self.set_image(options, tags)
+
+        # Write everything in one go, removing any ID3v1 tags like deleting the tags used to
+        tags.save(path, v1=0, v2_version=4)
 
-        logging.debug(f"Updated tags: {self.file_path(options.songs_path)}")
+        logging.debug(f"Updated tags: {path}")
         logging.debug(f"Previous encoding: {encoding}")
 
     def download_image(self, options):
@@ -190,48 +304,15 @@ class Song:
             logging.warning(f"Anilist ID not linked: {self.audio}")
             return False
 
-        query = """
-            query ($id: Int) {
-                Media(id: $id, type: ANIME) {
-                    coverImage {
-                        extraLarge
-                    }
-                }
-            }
-        """
         id = self.linked_ids['anilist']
+        return get_cover_service(options).fetch([id])[id]
 
-        r = requests.post(
-            "https://graphql.anilist.co",
-            json={'query': query, 'variables': {"id": id}},
-        )
-
-        # Anilist rate limit is 30 requests per minute
-        time.sleep(2)
-
-        if not r.ok:
-            logging.warning(f"Bad request for Anilist query")
-            return False
-
-        json = r.json()
-        image_url = json['data']['Media']['coverImage']['extraLarge']
-
-        r = requests.get(image_url)
-
-        if not r.ok:
-            logging.warning(f"Bad request Anilist image query")
-            return False
-
-        with open(self.image_file_path(options.covers_path), 'wb') as f:
-            logging.debug(f"Saving file: {self.image_file_path(options.covers_path)}")
-            f.write(r.content)
-
-        return True
-
-    def set_image(self, options):
+    def set_image(self, options, tags):
         '''
-        Sets mp3 cover art.
+        Adds mp3 cover art to tags.
         '''
+        from mutagen.id3 import APIC
+
         # If the cover doesn't exist, don't set the image
         if not self.image_file_path(options.covers_path):
             return
@@ -242,23 +323,27 @@ class Song:
             if not successfully_downloaded:
                 return
 
-        song = MP3(self.file_path(options.songs_path))
+        mime, data = get_cover_service(options).read(self.linked_ids['anilist'])
 
-        song.tags.add(
+        tags.add(
             APIC(
                 encoding=0,
                 type=3,
-                mime=filetype.guess(self.image_file_path(options.covers_path)).mime,
+                mime=mime,
                 desc=u"Cover",
-                data=open(self.image_file_path(options.covers_path), 'rb').read(),
+                data=data,
             )
         )
 
-        song.save()
-        logging.debug(f"Updated image: {self.file_path(options.songs_path)}")
+        logging.debug(f"Added image: {self.file_path(options.songs_path)}")
 
-    def play(self, options):
+    def play(self, options, gain=None):
         '''
-        Plays the song through the preferred player.
+        Plays the song through the preferred player, adjusting its volume by `gain` dB if the player is mpv.
         '''
-        subprocess.run(f"{options.player} {self.file_path(options.songs_path)}", shell=True, stdout=subprocess.PIPE)
+        command = options.player
+
+        if gain is not None and os.path.basename(command.split()[0]).startswith("mpv"):
+            command += f" --volume-gain={gain:.2f}"
+
+        subprocess.run(f"{command} {self.file_path(options.songs_path)}", shell=True, stdout=subprocess.PIPE)
@@ -0,0 +1,113 @@
+import functools, logging, threading, time
+from collections import defaultdict
+
+class Timer:
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+def percentile(samples, fraction):
+    '''
+    Gets a percentile of sorted samples, using the nearest rank.
+    '''
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+class Stats:
+    '''
+    Collects how long each stage of the player takes, so slow stages can be found from data instead of guesses.
+
+    Nothing is recorded unless stats are enabled, so the timers cost next to nothing during normal use.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+        # Bytes and seconds spent downloading from each host
+        self.downloads = defaultdict(lambda: [0, 0.0, 0])
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+        logging.debug(f"{stage} took {seconds * 1000:.2f}ms")
+
+    def record_download(self, host, size, seconds):
+        '''
+        Records a finished download, along with the host it came from.
+        '''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            totals = self.downloads[host]
+            totals[0] += size
+            totals[1] += seconds
+            totals[2] += 1
+
+        self.record("download", seconds)
+        logging.debug(f"Downloaded {size} bytes from {host} in {seconds:.2f}s ({size / seconds / 1024 if seconds else 0:.0f} KB/s)")
+
+    def timer(self, stage):
+        '''
+        Times the block inside a `with` statement.
+        '''
+        return Timer(self, stage) if self.enabled else NullTimer()
+
+    def timed(self, stage):
+        '''
+        Decorator that times every call of a function.
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+
+                start = time.perf_counter()
+
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+
+            return wrapper
+        return decorator
+
+    def report(self):
+        '''
+        Prints a summary of every stage, with percentiles, and download throughput for each host.
+        '''
+        if not self.samples:
+            return
+
+        print(f"{'stage':<20} {'count':>7} {'total':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+
+        for stage, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            times = [percentile(samples, fraction) * 1000 for fraction in (0.5, 0.9, 0.99)] + [samples[-1] * 1000]
+            print(f"{stage:<20} {len(samples):>7} {sum(samples):>8.2f}s " + " ".join(f"{value:>7.2f}ms" for value in times))
+
+        for host, (size, seconds, count) in sorted(self.downloads.items()):
+            throughput = size / seconds / 1024 if seconds else 0
+            print(f"{host}: {count} downloads, {size / 1024 / 1024:.1f} MB at {throughput:.0f} KB/s")
+
+stats = Stats()
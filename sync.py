@@ -0,0 +1,96 @@
+import logging, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tagging import Tagger
+
+# How long to wait before trying a failed download again, doubled for every attempt after that
+RETRY_DELAY = 5
+
+class Syncer:
+    '''
+    Downloads every song in a playlist that we don't have yet, so it can be played in offline mode later.
+
+    Downloads resume from partial files, and songs that are already downloaded or tagged are skipped, so syncing can be
+    stopped at any time and started again later.
+    '''
+    def __init__(self, options, songs):
+        self.options = options
+        self.songs = songs
+        self.tagger = Tagger(options)
+
+        # Set when syncing is stopped, so downloads that are waiting to try again give up instead
+        self.stopped = threading.Event()
+
+    def sync(self):
+        downloaded = [song for song in self.songs if song.is_downloaded(self.options.songs_path)]
+        missing = [song for song in self.songs if not song.is_downloaded(self.options.songs_path)]
+
+        print(f"{len(downloaded)}/{len(self.songs)} songs already downloaded, {len(missing)} to download")
+
+        # Get every cover up front in batches, so downloads don't fetch them one at a time while tagging
+        if self.options.include_cover_art:
+            self.tagger.download_covers(self.songs)
+
+        # Songs we downloaded before might have been tagged with different options
+        self.tagger.tag(downloaded)
+
+        try:
+            self.download(missing)
+        finally:
+            self.tagger.save()
+
+    def download(self, songs):
+        '''
+        Downloads songs in parallel, showing progress as they finish.
+        '''
+        if not songs:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.options.workers, thread_name_prefix="sync")
+        futures = {executor.submit(self.download_song, song): song for song in songs}
+        failed = []
+        start = time.perf_counter()
+
+        try:
+            for count, future in enumerate(as_completed(futures), 1):
+                song = futures[future]
+
+                try:
+                    if not future.result():
+                        failed.append(song)
+                except Exception as e:
+                    logging.warning(f"Failed to download {song.full_name(self.options.prefer_english)}: {e}")
+                    failed.append(song)
+
+                elapsed = time.perf_counter() - start
+                print(f"\rDownloaded {count - len(failed)}/{len(songs)} songs, {len(failed)} failed ({count / elapsed:.1f} songs/s)", end="", flush=True)
+
+        except KeyboardInterrupt:
+            self.stopped.set()
+            print("\nStopping after the songs already downloading, sync again to carry on from here")
+            raise
+
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        print()
+
+        for song in failed:
+            print(f"Could not download: {song.full_name(self.options.prefer_english)} ({song.audio})")
+
+    def download_song(self, song):
+        '''
+        Downloads a song, trying again with a longer wait each time it fails.
+        '''
+        for attempt in range(self.options.sync_retries + 1):
+            if attempt:
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                logging.info(f"Retrying {song.audio} in {delay} seconds")
+
+                if self.stopped.wait(delay):
+                    return False
+
+            if song.download(self.options):
+                self.tagger.remember(song)
+                return True
+
+        return False
@@ -0,0 +1,96 @@
+import functools
+import numpy as np
+
+SEASONS = ["winter", "spring", "summer", "fall"]
+
+def vintage(text):
+    '''
+    Gets the first and last season of a vintage like "Fall 2020" or "2020" as numbers that sort in order, or None if
+    it isn't a vintage.
+    '''
+    words = text.lower().split() if text else []
+
+    try:
+        match words:
+            case [year]:
+                return int(year) * 4, int(year) * 4 + 3
+            case [season, year] if season in SEASONS:
+                code = int(year) * 4 + SEASONS.index(season)
+                return code, code
+    except ValueError:
+        pass
+
+    return None
+
+def categories(values):
+    '''
+    Encodes values as numbers, returning the number of each value and the value each number stands for.
+    '''
+    numbers = {}
+    codes = np.fromiter((numbers.setdefault(value, len(numbers)) for value in values), dtype=np.int32)
+    return codes, list(numbers)
+
+class SongTable:
+    '''
+    Numeric song fields stored as columns, so filters and sums over a whole playlist run as array operations.
+    '''
+    def __init__(self, songs):
+        self.songs = songs
+        count = len(songs)
+
+        # Songs without a difficulty get NaN, which never passes a difficulty comparison
+        self.difficulty = np.fromiter((song.difficulty or np.nan for song in songs), dtype=np.float64, count=count)
+        self.duration = np.fromiter((song.duration for song in songs), dtype=np.float64, count=count)
+
+    # Text columns are only encoded when a filter needs them. Lists repeat the same few values, so they're stored as
+    # categories and filters only have to check each distinct value once
+    @functools.cached_property
+    def song_type(self):
+        return categories(song.type for song in self.songs)
+
+    @functools.cached_property
+    def anime_type(self):
+        return categories(song.anime.type for song in self.songs)
+
+    @functools.cached_property
+    def vintage(self):
+        # Songs without a vintage get NaN, like difficulty
+        codes, seasons = categories(song.season for song in self.songs)
+        lookup = np.array([(vintage(season) or (np.nan,))[0] for season in seasons], dtype=np.float64)
+        return lookup[codes]
+
+    def __len__(self):
+        return len(self.songs)
+
+    def all(self):
+        '''
+        Gets a mask selecting every song.
+        '''
+        return np.ones(len(self.songs), dtype=bool)
+
+    def mask(self, predicate, where=None):
+        '''
+        Gets a mask of songs matching a predicate, for checks that can't be done on columns. If `where` is given, only
+        the songs it selects are checked.
+        '''
+        if where is None:
+            return np.fromiter((predicate(song) for song in self.songs), dtype=bool, count=len(self.songs))
+
+        positions = np.flatnonzero(where)
+        mask = np.zeros(len(self.songs), dtype=bool)
+        mask[positions] = np.fromiter((predicate(self.songs[position]) for position in positions), dtype=bool, count=len(positions))
+        return mask
+
+    def category_mask(self, column, predicate):
+        '''
+        Gets a mask of songs whose value in a category column matches a predicate.
+        '''
+        codes, values = column
+        matches = np.fromiter((predicate(value) for value in values), dtype=bool, count=len(values))
+        return matches[codes]
+
+    def select(self, mask):
+        '''
+        Gets the songs selected by a mask.
+        '''
+        return [self.songs[index] for index in np.flatnonzero(mask)]
@@ -0,0 +1,128 @@
+import hashlib, json, logging, os, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from covers import get_cover_service
+
+class Tagger:
+    '''
+    Sets the metadata of many songs at once on a pool of worker threads.
+
+    A fingerprint of the tags written to each file is saved along with the file's size and modification time, so files
+    that already have the tags we want are skipped without being opened.
+    '''
+    def __init__(self, options):
+        self.options = options
+        self.fingerprints_file = os.path.join(options.cache_path, "tags.json")
+        self.fingerprints = {}
+
+        try:
+            with open(self.fingerprints_file, 'r', encoding="utf-8") as f:
+                self.fingerprints = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Could not load tag fingerprints {self.fingerprints_file}: {e}")
+
+    def fingerprint(self, song):
+        '''
+        Gets a fingerprint of the tags `set_metadata` would write for a song.
+        '''
+        cover = None
+
+        if self.options.include_cover_art and song.image_file_path(self.options.covers_path):
+            try:
+                stat = os.stat(song.image_file_path(self.options.covers_path))
+                cover = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                # The cover hasn't been downloaded yet, so the song always needs tagging
+                return None
+
+        data = json.dumps([song.metadata(self.options), self.options.include_cover_art, self.options.cover_max_size, cover], sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def is_tagged(self, path, fingerprint):
+        '''
+        Checks if a file hasn't changed since we last tagged it with the same tags.
+        '''
+        if not fingerprint or path not in self.fingerprints:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        return self.fingerprints[path] == [stat.st_size, stat.st_mtime_ns, fingerprint]
+
+    def remember(self, song):
+        '''
+        Records that a song was just tagged somewhere else, like after downloading it, so it isn't tagged again.
+        '''
+        path = os.fspath(song.file_path(self.options.songs_path))
+        fingerprint = self.fingerprint(song)
+
+        if not fingerprint:
+            return
+
+        try:
+            stat = os.stat(path)
+            self.fingerprints[path] = [stat.st_size, stat.st_mtime_ns, fingerprint]
+        except OSError:
+            pass
+
+    def tag(self, songs):
+        '''
+        Sets the metadata of songs that aren't tagged how we want them yet.
+        '''
+        pending = []
+
+        for song in songs:
+            path = os.fspath(song.file_path(self.options.songs_path))
+            fingerprint = self.fingerprint(song)
+
+            if not self.is_tagged(path, fingerprint):
+                pending.append((song, path, fingerprint))
+
+        print(f"Skipping {len(songs) - len(pending)}/{len(songs)} songs that are already up to date")
+
+        if not pending:
+            return
+
+        # Fetch covers in batches before the workers need them, instead of one request for each song
+        if self.options.include_cover_art:
+            self.download_covers(song for song, _, _ in pending)
+            pending = [(song, path, self.fingerprint(song)) for song, path, _ in pending]
+
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.options.workers) as executor:
+            futures = {executor.submit(song.set_metadata, self.options): (song, path, fingerprint) for song, path, fingerprint in pending}
+
+            for count, future in enumerate(as_completed(futures), 1):
+                song, path, fingerprint = futures[future]
+
+                try:
+                    future.result()
+
+                    if fingerprint:
+                        stat = os.stat(path)
+                        self.fingerprints[path] = [stat.st_size, stat.st_mtime_ns, fingerprint]
+                except Exception as e:
+                    logging.warning(f"Failed to update metadata for {song.full_name(self.options.prefer_english)}: {e}")
+
+                elapsed = time.perf_counter() - start
+                print(f"\rUpdated metadata for {count}/{len(pending)} songs ({count / elapsed:.1f} songs/s)", end="", flush=True)
+
+        print()
+        self.save()
+
+    def download_covers(self, songs):
+        '''
+        Downloads covers that are missing, many anime at a time.
+        '''
+        ids = {song.linked_ids['anilist'] for song in songs if song.image_file_path(self.options.covers_path)}
+        get_cover_service(self.options).fetch(ids)
+
+    def save(self):
+        try:
+            with open(self.fingerprints_file, 'w', encoding="utf-8") as f:
+                json.dump(self.fingerprints, f)
+        except OSError as e:
+            logging.warning(f"Failed to save tag fingerprints {self.fingerprints_file}: {e}")
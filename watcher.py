@@ -0,0 +1,170 @@
+import ctypes, ctypes.util, logging, os, queue, select, struct, sys, threading
+
+# How often to check files for changes when we can't be notified about them
+POLL_INTERVAL = 2
+
+# inotify events for files being written, moved in or out, or deleted
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+class ListWatcher:
+    '''
+    Watches list files and directories for changes in the background.
+
+    On Linux, changes come from inotify. Everywhere else, or if inotify isn't available, files are polled instead.
+    Changed files are collected until `changes` is called, so they can be handled between songs. `close` stops watching.
+    '''
+    def __init__(self, paths):
+        self.dirs = set()
+        self.files = set()
+        self.changed = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # The inotify file descriptor, and a pipe for waking up the thread reading it when we stop
+        self.fd = None
+        self.wake = None
+
+        for path in paths:
+            path = os.path.normpath(path)
+
+            if os.path.isdir(path):
+                self.dirs.add(path)
+            else:
+                self.files.add(path)
+
+    def start(self):
+        if sys.platform.startswith("linux"):
+            try:
+                self.fd = self.inotify_init()
+                self.wake = os.pipe()
+                self.thread = threading.Thread(target=self.read_inotify, args=(self.fd,), name="watcher", daemon=True)
+                self.thread.start()
+                logging.debug("Watching lists with inotify")
+                return
+            except OSError as e:
+                logging.info(f"inotify is not available, polling lists instead: {e}")
+
+        self.thread = threading.Thread(target=self.poll, name="watcher", daemon=True)
+        self.thread.start()
+        logging.debug("Watching lists by polling")
+
+    def close(self):
+        '''
+        Stops watching, and releases the inotify file descriptor.
+        '''
+        self.stopped.set()
+
+        if self.wake:
+            os.write(self.wake[1], b"\0")
+
+        if self.thread:
+            self.thread.join()
+
+        for fd in (self.fd, *(self.wake or ())):
+            if fd is not None:
+                os.close(fd)
+
+        self.fd = self.wake = self.thread = None
+
+    def is_watched(self, path):
+        '''
+        Checks if a file belongs to the lists we're playing. Like loading, this doesn't include subdirectories.
+        '''
+        return path in self.files or os.path.dirname(path) in self.dirs
+
+    def changes(self):
+        '''
+        Gets the files that changed since the last call.
+        '''
+        changed = set()
+
+        while not self.changed.empty():
+            changed.add(self.changed.get_nowait())
+
+        return changed
+
+    def inotify_init(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.watches = {}
+
+        # Watch the directories that files are in, since editors often replace files instead of writing to them
+        for dir in self.dirs | {os.path.dirname(file) or "." for file in self.files}:
+            wd = libc.inotify_add_watch(fd, os.fsencode(dir), WATCH_MASK)
+
+            if wd < 0:
+                logging.warning(f"Failed to watch {dir}: {os.strerror(ctypes.get_errno())}")
+                continue
+
+            self.watches[wd] = "" if dir == "." else dir
+
+        return fd
+
+    def read_inotify(self, fd):
+        while True:
+            select.select([fd, self.wake[0]], [], [])
+
+            if self.stopped.is_set():
+                return
+
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+
+                if wd not in self.watches or not name:
+                    continue
+
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+
+                if self.is_watched(path):
+                    logging.debug(f"List changed: {path}")
+                    self.changed.put(path)
+
+    def snapshot(self):
+        '''
+        Gets the size and modification time of every watched file.
+        '''
+        files = set(self.files)
+
+        for dir in self.dirs:
+            try:
+                files.update(entry.path for entry in os.scandir(dir) if entry.is_file())
+            except OSError:
+                pass
+
+        snapshot = {}
+
+        for file in files:
+            try:
+                stat = os.stat(file)
+                snapshot[file] = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                pass
+
+        return snapshot
+
+    def poll(self):
+        previous = self.snapshot()
+
+        while not self.stopped.wait(POLL_INTERVAL):
+            current = self.snapshot()
+
+            for path in previous.keys() | current.keys():
+                if previous.get(path) != current.get(path):
+                    logging.debug(f"List changed: {path}")
+                    self.changed.put(path)
+
+            previous = current